@@ -0,0 +1,61 @@
+import argparse
+import os
+
+import numpy
+import pandas
+
+from utils.dataset_schema import timestamp_format
+
+
+def generate_dataset(rows, sensors=500, invalid_ratio=0.05, duplicate_ratio=0.01, start="2017-07-01", days=31, seed=42):
+    # synthetic sofia air quality file in the shape of the source csv (unnamed index, sensor_id, location, lat, lon,
+    # timestamp, pressure, temperature, humidity) - every sensor has a fixed location, readings are in time order
+    rng = numpy.random.default_rng(seed)
+    sensor_ids = rng.choice(numpy.arange(1000, 15000), size=sensors, replace=False)
+    sensor_locations = rng.choice(numpy.arange(500, 8000), size=sensors, replace=False)
+    sensor_latitudes = rng.uniform(42.6, 42.7, sensors).round(3)
+    sensor_longitudes = rng.uniform(23.2, 23.4, sensors).round(3)
+
+    unique_rows = rows - int(rows * duplicate_ratio)
+    sensor_index = rng.integers(0, sensors, unique_rows)
+    timestamps = pandas.Timestamp(start) + pandas.to_timedelta(numpy.sort(rng.integers(0, days * 86400, unique_rows)), unit="s")
+    dataset_df = pandas.DataFrame({
+        "sensor_id": sensor_ids[sensor_index],
+        "location": sensor_locations[sensor_index],
+        "lat": sensor_latitudes[sensor_index],
+        "lon": sensor_longitudes[sensor_index],
+        "timestamp": timestamps.strftime(timestamp_format),
+        "pressure": rng.normal(95000, 1500, unique_rows).round(2),
+        "temperature": rng.normal(20, 8, unique_rows).round(2),
+        "humidity": rng.uniform(10, 90, unique_rows).round(2),
+    })
+
+    # invalid rows - out of range readings and nulls in the share of invalid_ratio (no values of the wrong type, a
+    # single string turns the whole column into strings on read and every row of the file is quarantined)
+    invalid_rows = numpy.flatnonzero(rng.random(unique_rows) < invalid_ratio)
+    invalid_kind = rng.integers(0, 3, len(invalid_rows))
+    dataset_df.loc[invalid_rows[invalid_kind == 0], "temperature"] = 75.0
+    dataset_df.loc[invalid_rows[invalid_kind == 1], "humidity"] = 120.0
+    dataset_df.loc[invalid_rows[invalid_kind == 2], "pressure"] = numpy.nan
+
+    # duplicates - exact copies of random rows, the pipeline is expected to drop them
+    duplicate_rows = dataset_df.iloc[rng.integers(0, unique_rows, rows - unique_rows)]
+    dataset_df = pandas.concat([dataset_df, duplicate_rows]).sort_values("timestamp", kind="stable")
+    return dataset_df.reset_index(drop=True)
+
+def write_dataset(dataset_path, dataset_df):
+    # written under a temp name and renamed, the file watcher only ever sees complete files
+    dataset_df.to_csv(f"{dataset_path}.tmp", index=True)
+    os.replace(f"{dataset_path}.tmp", dataset_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic sofia air quality csv file")
+    parser.add_argument("output")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--sensors", type=int, default=500)
+    parser.add_argument("--invalid-ratio", type=float, default=0.05)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    write_dataset(args.output, generate_dataset(args.rows, args.sensors, args.invalid_ratio, args.duplicate_ratio, seed=args.seed))
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas
+
+from benchmarks.data_generator import generate_dataset, write_dataset
+from data_processing import read_dataset, data_validation, data_standardisation, data_post_processing, data_rollup_processing
+from db_manager import Database, bootstrap_database, close_connection_pool
+from utils.db_schema import db_config
+from utils.pipeline_config import pipeline_config
+from utils.processing_ledger import get_processing_ledger
+from utils.quarantine_writer import QuarantineWriter
+
+
+STAGES = ["read", "deduplication", "validation", "standardisation", "aggregation", "quarantine_write", "db_write"]
+
+
+class FakeCursor:
+    def __init__(self):
+        self.copied_bytes = 0
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.rowcount = 0
+
+    def copy_expert(self, query, buffer):
+        self.copied_bytes += len(buffer.getvalue())
+
+
+class FakeDatabase:
+    # in memory stand-in for Database - the frames are serialised for COPY like the real writes (client side cost),
+    # nothing is sent anywhere, so the benchmark measures the pipeline without a database server
+    def __init__(self, config=None):
+        self.config = config
+        self.cur = FakeCursor()
+        self.tables = {"sensors": 0, "sensor_raw_data": 0, "sensor_aggregated_metrics": 0, "sensor_rollup": 0}
+
+    def connect(self):
+        pass
+
+    def close(self):
+        pass
+
+    def create_tables(self):
+        pass
+
+    def update_sensors(self, raw_data):
+        sensors_df = raw_data.drop_duplicates("sensor_id", keep="last")
+        Database.copy_to_staging(self.cur, sensors_df, ["sensor_id", "location_id", "latitude", "longitude"], None)
+        self.tables["sensors"] = len(sensors_df)
+
+    def update_sensor_raw_data(self, raw_data):
+        Database.copy_to_staging(self.cur, raw_data, ["sensor_id", "timestamp", "pressure", "temperature", "humidity"], None)
+        self.tables["sensor_raw_data"] += len(raw_data)
+
+    def update_sensor_aggregated_metrics(self, aggregated_data, rollup_data=None):
+        Database.copy_to_staging(self.cur, aggregated_data, list(aggregated_data.columns), None)
+        self.tables["sensor_aggregated_metrics"] += len(aggregated_data)
+        if rollup_data is not None:
+            Database.copy_to_staging(self.cur, rollup_data, list(rollup_data.columns), None)
+            self.tables["sensor_rollup"] += len(rollup_data)
+
+    def update_batch(self, raw_data, aggregated_data, rollup_data=None):
+        self.update_sensors(raw_data)
+        self.update_sensor_raw_data(raw_data)
+        self.update_sensor_aggregated_metrics(aggregated_data, rollup_data)
+
+
+def timed(stage_times, stage, function, *args):
+    start_time = time.perf_counter()
+    result = function(*args)
+    stage_times[stage] = stage_times.get(stage, 0) + time.perf_counter() - start_time
+    return result
+
+def run_stages(dataset_path, db, quarantine_writer):
+    # same steps as data_staged_processing, each one timed on its own
+    stage_times = {}
+    dataset_df = timed(stage_times, "read", read_dataset, dataset_path)
+    dataset_df = timed(stage_times, "deduplication", dataset_df.drop_duplicates)
+
+    validation_df = timed(stage_times, "validation", data_validation, dataset_df)
+    valid_data_df = dataset_df[validation_df["validity"]]
+    invalid_data_df = pandas.concat([dataset_df, validation_df], axis=1)[~validation_df["validity"]]
+    valid_data_df = timed(stage_times, "standardisation", data_standardisation, valid_data_df.copy())
+
+    aggregated_data = timed(stage_times, "aggregation", data_post_processing, valid_data_df, dataset_path)
+    rollup_data = timed(stage_times, "aggregation", data_rollup_processing, valid_data_df, dataset_path)
+
+    # timed in the foreground - the pipeline hides most of it behind the other stages
+    timed(stage_times, "quarantine_write", quarantine_writer.write_part, dataset_path, 0, invalid_data_df)
+
+    def db_write():
+        db.connect()
+        try:
+            db.update_sensors(valid_data_df)
+            db.update_sensor_raw_data(valid_data_df)
+            db.update_sensor_aggregated_metrics(aggregated_data, rollup_data)
+        finally:
+            db.close()
+    timed(stage_times, "db_write", db_write)
+    return stage_times, len(dataset_df), len(valid_data_df)
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(args):
+    if args.db == "postgres":
+        # meant for a throwaway database, the benchmark rows are written like any other file - a new invocation on the
+        # same database writes the keys of the previous one again
+        config = dict(db_config, host=args.db_host, port=args.db_port, user=args.db_user, password=args.db_password, dbname=args.db_name)
+        bootstrap_database(config)
+        db = Database(config)
+    else:
+        db = FakeDatabase()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as work_folder:
+        quarantine_writer = QuarantineWriter(os.path.join(work_folder, "quarantine"))
+        for run in range(args.repeat):
+            # same seed on every run, but the readings of the next 31 days - in postgres mode a run writing the keys of
+            # an earlier one would only measure ON CONFLICT DO NOTHING
+            dataset_df = generate_dataset(
+                args.rows, args.sensors, args.invalid_ratio, args.duplicate_ratio,
+                start=pandas.Timestamp("2017-07-01") + timedelta(days=31 * run), days=31, seed=args.seed
+            )
+            # a new file name on every run, the file lineage would skip the aggregates of a file seen before
+            dataset_path = os.path.join(work_folder, f"benchmark_{datetime.now():%Y%m%d%H%M%S}_{run}.csv")
+            write_dataset(dataset_path, dataset_df)
+            stage_times, total_rows, valid_rows = run_stages(dataset_path, db, quarantine_writer)
+            runs.append(stage_times)
+    if args.db == "postgres":
+        close_connection_pool()
+
+    # median over the runs, the first run includes warm up (imports, caches, partition creation)
+    stages = {stage: statistics.median(run[stage] for run in runs) for stage in STAGES}
+    total_seconds = sum(stages.values())
+    return {
+        "benchmark": "pipeline",
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "database": args.db,
+        "parameters": {
+            "rows": args.rows, "sensors": args.sensors, "invalid_ratio": args.invalid_ratio,
+            "duplicate_ratio": args.duplicate_ratio, "seed": args.seed, "repeat": args.repeat,
+        },
+        "total_rows": total_rows,
+        "valid_rows": valid_rows,
+        "stages": stages,
+        "total_seconds": total_seconds,
+        "rows_per_second": total_rows / total_seconds,
+        "runs": runs,
+    }
+
+def run_replay(args):
+    # drops files into the data folder at a target rate and measures the time until the processing ledger reports
+    # each of them completed - event_listener has to be running (or is started with --start-listener)
+    folder_path = pipeline_config["data_folder"]
+    processing_ledger = get_processing_ledger()
+    listener = subprocess.Popen([sys.executable, "event_listener.py"]) if args.start_listener else None
+
+    dropped_files = {}
+    latencies = {}
+    try:
+        if listener:
+            time.sleep(args.warmup)
+        interval = 1 / args.rate
+        for file_number in range(args.files):
+            dataset_df = generate_dataset(args.rows, args.sensors, args.invalid_ratio, args.duplicate_ratio, seed=args.seed + file_number)
+            dataset_path = os.path.join(folder_path, f"replay_{datetime.now():%Y%m%d%H%M%S}_{file_number}.csv")
+            write_dataset(dataset_path, dataset_df)
+            dropped_files[dataset_path] = time.perf_counter()
+            next_drop_time = time.perf_counter() + interval
+            while time.perf_counter() < next_drop_time:
+                collect_latencies(processing_ledger, dropped_files, latencies)
+                time.sleep(0.05)
+
+        timeout_time = time.perf_counter() + args.timeout
+        while len(latencies) < len(dropped_files) and time.perf_counter() < timeout_time:
+            collect_latencies(processing_ledger, dropped_files, latencies)
+            time.sleep(0.05)
+    finally:
+        if listener:
+            listener.terminate()
+            listener.wait()
+
+    latency_values = sorted(latencies.values())
+    return {
+        "benchmark": "replay",
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "parameters": {"files": args.files, "rate": args.rate, "rows": args.rows, "sensors": args.sensors},
+        "completed_files": len(latencies),
+        "timed_out_files": sorted(set(dropped_files) - set(latencies)),
+        "latency_seconds": {
+            "min": latency_values[0] if latency_values else None,
+            "median": statistics.median(latency_values) if latency_values else None,
+            "p95": latency_values[int(0.95 * (len(latency_values) - 1))] if latency_values else None,
+            "max": latency_values[-1] if latency_values else None,
+        },
+        "files": latencies,
+    }
+
+def collect_latencies(processing_ledger, dropped_files, latencies):
+    for dataset_path, drop_time in dropped_files.items():
+        if dataset_path not in latencies and processing_ledger.get_stage(dataset_path) == "completed":
+            latencies[dataset_path] = time.perf_counter() - drop_time
+
+def compare_results(results, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    print(f"compared with {baseline.get('commit')} ({baseline_path})")
+    for stage in STAGES:
+        change = (results["stages"][stage] - baseline["stages"][stage]) / baseline["stages"][stage] * 100
+        print(f"{stage:<20} : {baseline['stages'][stage]:.3f} -> {results['stages'][stage]:.3f} seconds ({change:+.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic sofia air quality data")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--sensors", type=int, default=500)
+    parser.add_argument("--invalid-ratio", type=float, default=0.05)
+    parser.add_argument("--duplicate-ratio", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--db", choices=["fake", "postgres"], default="fake")
+    parser.add_argument("--db-host", default=db_config["host"])
+    parser.add_argument("--db-port", type=int, default=db_config["port"])
+    parser.add_argument("--db-user", default=db_config["user"])
+    parser.add_argument("--db-password", default=db_config["password"])
+    parser.add_argument("--db-name", default="pipeline_benchmark")
+    parser.add_argument("--replay", action="store_true", help="drop files into the data folder and measure end-to-end latency")
+    parser.add_argument("--files", type=int, default=10, help="replay: number of files")
+    parser.add_argument("--rate", type=float, default=1.0, help="replay: files per second")
+    parser.add_argument("--timeout", type=float, default=300, help="replay: seconds to wait for the last files")
+    parser.add_argument("--start-listener", action="store_true", help="replay: start event_listener.py for the run")
+    parser.add_argument("--warmup", type=float, default=5, help="replay: seconds given to the started listener")
+    parser.add_argument("--output", help="json results file (default: benchmarks/results/<benchmark>_<commit>.json)")
+    parser.add_argument("--compare", help="json results file of an earlier run to compare the stages with")
+    args = parser.parse_args()
+
+    results = run_replay(args) if args.replay else run_benchmark(args)
+
+    output_path = args.output or os.path.join("benchmarks", "results", f"{results['benchmark']}_{results['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path, "w") as output_file:
+        json.dump(results, output_file, indent=2, default=str)
+
+    if args.replay:
+        print(f"completed files            : {results['completed_files']} of {args.files}")
+        for name, value in results["latency_seconds"].items():
+            print(f"latency {name:<18} : {value:.2f} seconds" if value is not None else f"latency {name:<18} : -")
+    else:
+        for stage in STAGES:
+            print(f"{stage:<26} : {results['stages'][stage]:.3f} seconds")
+        print(f"{'rows per second':<26} : {results['rows_per_second']:.0f}")
+        if args.compare:
+            compare_results(results, args.compare)
+    print(f"results written to {output_path}")
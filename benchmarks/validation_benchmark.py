@@ -0,0 +1,62 @@
+import argparse
+import time
+
+import numpy
+import pandas
+
+from data_processing import data_validation, data_validation_check
+from utils.dataset_schema import timestamp_format
+
+
+def build_dataset(rows, invalid_ratio=0.05, seed=42):
+    # sofia air quality shaped frame with a share of nulls and out of range readings
+    rng = numpy.random.default_rng(seed)
+    dataset_df = pandas.DataFrame({
+        "sensor_id": rng.integers(1000, 15000, rows),
+        "location_id": rng.integers(500, 8000, rows),
+        "latitude": rng.uniform(42.6, 42.7, rows).round(3),
+        "longitude": rng.uniform(23.2, 23.4, rows).round(3),
+        "timestamp": pandas.Timestamp("2017-07-01") + pandas.to_timedelta(rng.integers(0, 31 * 86400, rows), unit="s"),
+        "pressure": rng.uniform(90000, 100000, rows).round(2),
+        "temperature": rng.uniform(-10, 40, rows).round(2),
+        "humidity": rng.uniform(10, 90, rows).round(2),
+    })
+    dataset_df["timestamp"] = dataset_df["timestamp"].dt.strftime(timestamp_format)
+
+    invalid_rows = rng.random(rows) < invalid_ratio
+    dataset_df.loc[invalid_rows & (rng.random(rows) < 0.4), "temperature"] = 75.0
+    dataset_df.loc[invalid_rows & (rng.random(rows) < 0.4), "humidity"] = 120.0
+    dataset_df.loc[invalid_rows & (rng.random(rows) < 0.3), "pressure"] = numpy.nan
+    dataset_df.loc[invalid_rows & (rng.random(rows) < 0.1), "timestamp"] = "2017-07-01 00:00:00"
+    # timestamps as read_dataset returns them, the ones not in timestamp_format are left as text
+    timestamps = pandas.to_datetime(dataset_df["timestamp"], format=timestamp_format, errors="coerce")
+    dataset_df["timestamp"] = timestamps.astype(object).where(timestamps.notna(), dataset_df["timestamp"])
+    return dataset_df
+
+def run_benchmark(rows, reference_rows):
+    dataset_df = build_dataset(rows)
+
+    start_time = time.perf_counter()
+    vectorized_df = data_validation(dataset_df)[["reason", "validity"]]
+    vectorized_elapsed_time = time.perf_counter() - start_time
+
+    # per-row reference is timed on a sample and extrapolated, a full million row run takes several minutes
+    reference_df = dataset_df.head(reference_rows)
+    start_time = time.perf_counter()
+    per_row_df = reference_df.apply(lambda row: data_validation_check(row), axis=1)
+    per_row_elapsed_time = (time.perf_counter() - start_time) * rows / len(reference_df)
+
+    pandas.testing.assert_frame_equal(vectorized_df.head(reference_rows), per_row_df, check_dtype=False)
+
+    print(f"rows                       : {rows}")
+    print(f"data_validation            : {vectorized_elapsed_time:.2f} seconds")
+    print(f"data_validation_check      : {per_row_elapsed_time:.2f} seconds (extrapolated from {len(reference_df)} rows)")
+    print(f"speedup                    : {per_row_elapsed_time / vectorized_elapsed_time:.0f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vectorized validation against the per-row validation")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--reference-rows", type=int, default=50_000)
+    args = parser.parse_args()
+    run_benchmark(args.rows, args.reference_rows)
@@ -0,0 +1,58 @@
+import argparse
+from datetime import datetime, timedelta
+
+import pandas
+
+from db_manager import Database, init_connection_pool, close_connection_pool
+from utils.db_schema import db_config, sensor_raw_data_columns
+from utils.log_config import log_info
+from utils.pipeline_config import pipeline_config
+from utils.raw_data_archive import RawDataArchive, normalise_raw_data
+
+
+def compact_sensor_raw_data(cutoff, archive=None):
+    # tiered storage - monthly sensor_raw_data partitions entirely before the cutoff are moved to the parquet archive,
+    # the hot table (and its unique index) only keeps the recent months, whatever the age of the pipeline
+    # meant to run periodically (eg: daily from cron), a partition that received late readings since its last
+    # compaction is simply compacted again
+    archive = archive or RawDataArchive(pipeline_config["archive_folder"])
+    db = Database(db_config)
+    db.connect()
+    try:
+        archived_rows = 0
+        for partition in db.fetch_sensor_raw_data_compactable_partitions(cutoff):
+            run_id = f"{partition}-{datetime.now():%Y%m%d%H%M%S}"
+            archived_rows += db.compact_sensor_raw_data_partition(partition, archive, run_id)
+        log_info("info", f"Compaction before {cutoff:%Y-%m-%d} complete ({archived_rows} readings archived)")
+        return archived_rows
+    finally:
+        db.close()
+
+def fetch_sensor_history(sensor_id, start_time, end_time, archive=None):
+    # readings of one sensor in [start_time, end_time) from sensor_raw_data and the archive, as one frame sorted by
+    # timestamp - a reading in both (archived again after a re-delivery) is returned once, from the database
+    archive = archive or RawDataArchive(pipeline_config["archive_folder"])
+    db = Database(db_config)
+    db.connect()
+    try:
+        raw_data = db.fetch_sensor_raw_data(sensor_id, start_time, end_time)
+    finally:
+        db.close()
+    raw_data_df = normalise_raw_data(pandas.DataFrame(raw_data, columns=sensor_raw_data_columns))
+    archive_df = archive.read(sensor_id, start_time, end_time)
+    if archive_df.empty:
+        return raw_data_df
+    history_df = pandas.concat([raw_data_df, archive_df], ignore_index=True) if not raw_data_df.empty else archive_df
+    return history_df.drop_duplicates(["timestamp"]).sort_values("timestamp", ignore_index=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive old sensor raw data partitions to parquet")
+    parser.add_argument("--age-days", type=int, default=pipeline_config["compaction_age_days"])
+    args = parser.parse_args()
+
+    init_connection_pool(db_config)
+    try:
+        compact_sensor_raw_data(datetime.now() - timedelta(days=args.age_days))
+    finally:
+        close_connection_pool()
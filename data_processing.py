@@ -1,22 +1,32 @@
+import os
+import queue
+import threading
 import pandas
 import time
+import numpy
 from datetime import datetime
 from pathlib import Path
 
 from db_manager import Database
 from utils.db_schema import db_config
 from utils.log_config import log_info
+from utils.metrics import metrics
+from utils.pipeline_config import pipeline_config
+from utils.processing_ledger import get_processing_ledger
+from utils.quarantine_writer import get_quarantine_writer, wait_for_quarantine
+from utils.pipelined_executor import PipelinedExecutor
+from utils.dataset_schema import dataset_columns, timestamp_format
+from utils.validation_rules import validation_rules, timestamp_rules, null_reason, data_type_reason, timestamp_reason, reason_bits, decode_reason_code
 
+try:
+    import pyarrow
+    import pyarrow.csv  # pyarrow csv reader is used for the typed read when installed
+    pyarrow_available = True
+except ImportError:
+    pyarrow_available = False
 
-def fetch_historical_sensor_aggregated_metrics(sensor_ids):
-    db = Database(db_config)
-    try:
-        db.connect()
-        historical_df = db.fetch_sensor_aggregated_metrics(sensor_ids)
-    finally:
-        db.close()
 
-    return historical_df
+aggregated_metric_columns = ["pressure", "temperature", "humidity"]
 
 def data_post_processing(dataset_df, dataset_path):
     # logs
@@ -26,97 +36,97 @@ def data_post_processing(dataset_df, dataset_path):
     if not required_columns.issubset(dataset_df.columns):
         raise ValueError(f"Dataset must contain the following columns: {required_columns}")
 
-    # group by sensor_id
-    grouped_analysis_df = dataset_df.groupby(["sensor_id", "location_id", "latitude", "longitude"]).agg(
+    # compact float32 readings are widened before summing, rounding restores the standardised 3 decimal values
+    float32_columns = dataset_df.select_dtypes(include=["float32"]).columns
+    dataset_df = dataset_df.assign(**{column: dataset_df[column].astype("float64").round(3) for column in float32_columns})
+
+    # group by sensor_id - sufficient statistics (count, sum, M2) are stored so the database can merge them exactly with
+    # the existing aggregates, avg/std are derived from them in the database, location data is kept in the sensors table
+    # a micro-batch of several files has the file of every row in source_file, its aggregates are kept per file
+    group_columns = ["sensor_id", "source_file"] if "source_file" in dataset_df.columns else ["sensor_id"]
+    grouped_dataset = dataset_df.groupby(group_columns, observed=True)
+    grouped_analysis_df = grouped_dataset.agg(
+        reading_count=("timestamp", "size"),
+        min_timestamp=("timestamp", "min"),
+        max_timestamp=("timestamp", "max"),
         min_pressure=("pressure", "min"),
         max_pressure=("pressure", "max"),
-        avg_pressure=("pressure", "mean"),
-        std_pressure=("pressure", "std"),
+        sum_pressure=("pressure", "sum"),
         min_temperature=("temperature", "min"),
         max_temperature=("temperature", "max"),
-        avg_temperature=("temperature", "mean"),
-        std_temperature=("temperature", "std"),
+        sum_temperature=("temperature", "sum"),
         min_humidity=("humidity", "min"),
         max_humidity=("humidity", "max"),
-        avg_humidity=("humidity", "mean"),
-        std_humidity=("humidity", "std"),
-    ).reset_index()
-
-    # round off to 3 decimal places - this is wrt to standardization
-    rounded_columns = [
-        'min_pressure', 'max_pressure', 'avg_pressure', 'std_pressure',
-        'min_temperature', 'max_temperature', 'avg_temperature', 'std_temperature',
-        'min_humidity', 'max_humidity', 'avg_humidity', 'std_humidity'
-    ]
-    grouped_analysis_df[rounded_columns] = grouped_analysis_df[rounded_columns].round(3)
-
-    # fn to get metadata
-    def collect_metadata(group):
-        source_metadata = [
-            {
-                "timestamp": row["timestamp"],
-                "pressure": row["pressure"],
-                "temperature": row["temperature"],
-                "humidity": row["humidity"],
-            }
-            for _, row in group.iterrows()
-        ]
-        # why like this - because in db each file can have a metadata kept seperately for further verifications if necessary
-        return {dataset_path: source_metadata}
-
-    metadata_df = (
-        dataset_df.groupby("sensor_id")
-        .apply(collect_metadata)
-        .reset_index(name="metadata")
+        sum_humidity=("humidity", "sum"),
     )
+    # M2 - sum of squared deviations from the sensor mean
+    for column in aggregated_metric_columns:
+        deviations = dataset_df[column] - grouped_dataset[column].transform("mean")
+        grouped_analysis_df[f"m2_{column}"] = (deviations ** 2).groupby([dataset_df[group_column] for group_column in group_columns], observed=True).sum()
+    grouped_analysis_df = grouped_analysis_df.reset_index()
 
-    combined_df = pandas.merge(grouped_analysis_df, metadata_df, on="sensor_id")
-    combined_df["last_updated"] = datetime.now()
-
-    # merge historical and current aggregated data
-    sensor_ids = combined_df["sensor_id"].unique().tolist()
-    historical_data = fetch_historical_sensor_aggregated_metrics(sensor_ids)
-    if historical_data:
-        historical_df = pandas.DataFrame(historical_data, columns=[
-            "sensor_id", "location_id", "latitude", "longitude",
-            "min_pressure", "max_pressure", "avg_pressure", "std_pressure",
-            "min_temperature", "max_temperature", "avg_temperature", "std_temperature",
-            "min_humidity", "max_humidity", "avg_humidity", "std_humidity"
-        ])
-
-        combined_df = pandas.concat([combined_df, historical_df])
-        combined_df = combined_df.groupby(["sensor_id", "location_id", "latitude", "longitude"]).agg(
-            min_pressure=("min_pressure", "min"),
-            max_pressure=("max_pressure", "max"),
-            avg_pressure=("avg_pressure", "mean"),
-            std_pressure=("std_pressure", "std"),
-            min_temperature=("min_temperature", "min"),
-            max_temperature=("max_temperature", "max"),
-            avg_temperature=("avg_temperature", "mean"),
-            std_temperature=("std_temperature", "std"),
-            min_humidity=("min_humidity", "min"),
-            max_humidity=("max_humidity", "max"),
-            avg_humidity=("avg_humidity", "mean"),
-            std_humidity=("std_humidity", "std"),
-        ).reset_index()
-
-        combined_df[rounded_columns] = combined_df[rounded_columns].round(3)
-
-        combined_df = pandas.merge(
-            combined_df, metadata_df, on="sensor_id", how="left"
-        )
-        combined_df["last_updated"] = datetime.now()
+    # file lineage - which file the readings of each sensor came from, kept in its own table instead of the aggregates
+    if "source_file" not in grouped_analysis_df.columns:
+        grouped_analysis_df["source_file"] = dataset_path
+    grouped_analysis_df["last_updated"] = datetime.now()
 
     # logs
     log_info("info", f"Data Post-Processing Completed for file {dataset_path}")
 
-    return combined_df
+    return grouped_analysis_df
+
+def data_rollup_processing(dataset_df, dataset_path):
+    # per sensor time bucketed rollups for every bucket size in the config - count/min/max/sum/sum of squares are
+    # additive, so the database merges them with the rows of earlier files falling in the same buckets
+    float32_columns = dataset_df.select_dtypes(include=["float32"]).columns
+    dataset_df = dataset_df.assign(**{column: dataset_df[column].astype("float64").round(3) for column in float32_columns})
+    dataset_df = dataset_df.assign(**{f"sq_{column}": dataset_df[column] ** 2 for column in aggregated_metric_columns})
+
+    # rollups of a micro-batch are kept per file (source_file column) like the aggregates
+    file_columns = [dataset_df["source_file"]] if "source_file" in dataset_df.columns else []
+    rollup_data = []
+    for bucket, frequency in pipeline_config["rollup_buckets"].items():
+        bucket_start = dataset_df["timestamp"].dt.floor(frequency).rename("bucket_start")
+        bucket_rollup_df = dataset_df.groupby([dataset_df["sensor_id"], bucket_start] + file_columns, observed=True).agg(
+            reading_count=("timestamp", "size"),
+            min_pressure=("pressure", "min"),
+            max_pressure=("pressure", "max"),
+            sum_pressure=("pressure", "sum"),
+            sum_sq_pressure=("sq_pressure", "sum"),
+            min_temperature=("temperature", "min"),
+            max_temperature=("temperature", "max"),
+            sum_temperature=("temperature", "sum"),
+            sum_sq_temperature=("sq_temperature", "sum"),
+            min_humidity=("humidity", "min"),
+            max_humidity=("humidity", "max"),
+            sum_humidity=("humidity", "sum"),
+            sum_sq_humidity=("sq_humidity", "sum"),
+        ).reset_index()
+        bucket_rollup_df.insert(0, "bucket", bucket)
+        rollup_data.append(bucket_rollup_df)
+    rollup_data = pandas.concat(rollup_data, ignore_index=True)
+    if "source_file" not in rollup_data.columns:
+        rollup_data["source_file"] = dataset_path
+    return rollup_data
+
+def data_new_readings(valid_data_df, db):
+    # readings the raw data write will insert - readings the dedup index knows to be stored and repeated
+    # (sensor_id, timestamp) keys are dropped by ON CONFLICT, they are left out of the aggregates and rollups as well
+    # so overlapping files are not counted twice (readings stored by other processes or before the index window are
+    # not known here and still counted), without db only the repeated keys are dropped
+    new_data_df = valid_data_df.drop_duplicates(["sensor_id", "timestamp"])
+    known = db.known_sensor_raw_data(new_data_df) if db is not None else None
+    if known is not None and known.any():
+        new_data_df = new_data_df[~known]
+    if len(new_data_df) < len(valid_data_df):
+        log_info("info", f"{len(valid_data_df) - len(new_data_df)} readings already stored are left out of the aggregates")
+    return new_data_df
 
 def data_standardisation(dataset_df):
     # logs
     log_info("info", "Data Standardisation Started")
 
-    float_columns = dataset_df.select_dtypes(include=['float64']).columns
+    float_columns = dataset_df.select_dtypes(include=['floating']).columns
     # round to 3 decimal places
     dataset_df[float_columns] = dataset_df[float_columns].round(3)
 
@@ -125,6 +135,7 @@ def data_standardisation(dataset_df):
     return dataset_df
 
 def data_validation_check(row):
+    # per-row validation, kept as the reference implementation for data_validation (see benchmarks/validation_benchmark.py)
     # valid pressure check can be added if known, but not added here since the unit is unknown (0 to 165k range mentioned in dataset)
 
     reasons = []
@@ -140,6 +151,10 @@ def data_validation_check(row):
         if not isinstance(row[column], (int, float)):
             reasons.append(f"Invalid data type in column '{column}'")
 
+    # timestamp not in timestamp_format (left as text by read_dataset)
+    if 'timestamp' in row and isinstance(row['timestamp'], str):
+        reasons.append(f"Invalid timestamp in column 'timestamp' (expected format {timestamp_format})")
+
     # invalid data
     if 'temperature' in row and not (-50 <= row['temperature'] <= 60):   # (-145 to 61.2 range mentioned in dataset)
         reasons.append("Temperature out of valid range (-50 to 60)")
@@ -153,18 +168,136 @@ def data_validation_check(row):
     validity = False if reasons else True
     return pandas.Series({"reason": ", ".join(reasons) if reasons else None, "validity": validity})
 
-def data_pre_processing(dataset_path):
-    ''' DATA PRE-PROCESSING '''
-    log_info("info", f"Pre-Processing Started for file {dataset_path}")
-    pre_processing_start_time = time.time()
-    dataset_df = pandas.read_csv(str(Path(dataset_path).resolve(strict=False))).drop_duplicates()
+def validation_checks(dataset_df):
+    # list of (reason, failed rows mask) in the order the reasons are reported
+    checks = [(null_reason, dataset_df.isnull().any(axis=1))]
+
+    numeric_columns = {}
+    for rule in validation_rules:
+        column = rule["column"]
+        if not rule["numeric"] or column not in dataset_df.columns:
+            continue
+        column_values = dataset_df[column]
+        if pandas.api.types.is_numeric_dtype(column_values) and not pandas.api.types.is_bool_dtype(column_values):
+            invalid_type_mask = pandas.Series(False, index=dataset_df.index)
+            numeric_columns[column] = column_values
+        else:
+            # only columns with mixed values end up here (eg: a string in a numeric column), so the element check is rare
+            invalid_type_mask = ~column_values.map(lambda value: isinstance(value, (int, float)))
+            numeric_columns[column] = pandas.to_numeric(column_values, errors="coerce")
+        checks.append((data_type_reason.format(column=column), invalid_type_mask))
+
+    for rule in timestamp_rules:
+        column = rule["column"]
+        if column not in dataset_df.columns:
+            continue
+        column_values = dataset_df[column]
+        if pandas.api.types.is_datetime64_any_dtype(column_values):
+            invalid_timestamp_mask = pandas.Series(False, index=dataset_df.index)
+        else:
+            # values data_compact_dtypes could not parse are left as text, missing ones are already NULL
+            invalid_timestamp_mask = column_values.notna() & ~column_values.map(lambda value: isinstance(value, pandas.Timestamp))
+        checks.append((timestamp_reason.format(column=column), invalid_timestamp_mask))
+
+    for rule in validation_rules:
+        column = rule["column"]
+        if rule["range_reason"] is None or column not in numeric_columns:
+            continue
+        # NULL values are reported as out of range as well, same as the comparison in data_validation_check
+        in_range_mask = numeric_columns[column].between(rule["min"], rule["max"]).fillna(False).astype(bool)
+        checks.append((rule["range_reason"], ~in_range_mask))
+
+    return checks
+
+def data_validation(dataset_df):
+    checks = validation_checks(dataset_df)
+
+    # every failed check sets its bit (reason_bits), so the reason text is only built once per distinct combination
+    # and the code itself is what gets stored with quarantined rows
+    reason_code = numpy.zeros(len(dataset_df), dtype=numpy.int64)
+    for reason, failed_mask in checks:
+        reason_code |= failed_mask.to_numpy(dtype=bool).astype(numpy.int64) << reason_bits[reason]
+
+    reason_text = {code: decode_reason_code(code) for code in numpy.unique(reason_code) if code}
+    reason_code = pandas.Series(reason_code, index=dataset_df.index)
+
+    return pandas.DataFrame({
+        "reason": reason_code.map(reason_text).astype(object).where(reason_code != 0, None),
+        "reason_code": reason_code,
+        "validity": reason_code == 0,
+    })
+
+def data_column_mapping(dataset_df):
     dataset_df = dataset_df.rename(columns={"lat": "latitude", "lon": "longitude", "location":"location_id"})
-    dataset_df = dataset_df.loc[:, ~dataset_df.columns.str.contains('^Unnamed')]
-    validation_check_dataset_df = dataset_df.apply(lambda row: data_validation_check(row), axis=1)
+    return dataset_df.loc[:, ~dataset_df.columns.str.contains('^Unnamed')]
+
+def data_compact_dtypes(dataset_df):
+    # cast columns that were read untyped to the compact dtypes of the dataset schema, columns holding values of the
+    # wrong type (eg: a string in a numeric column) are left as they are so the validation can report them
+    for column_spec in dataset_columns:
+        column = column_spec["column"]
+        if column not in dataset_df.columns:
+            continue
+        if column_spec["dtype"] == "datetime":
+            timestamps = pandas.to_datetime(dataset_df[column], format=timestamp_format, errors="coerce")
+            unparsed_mask = timestamps.isna() & dataset_df[column].notna()
+            if unparsed_mask.any():
+                # values not in timestamp_format are kept as text so the validation can report them (and not as NULL)
+                timestamps = timestamps.astype(object).where(~unparsed_mask, dataset_df[column])
+            dataset_df[column] = timestamps
+        elif pandas.api.types.is_numeric_dtype(dataset_df[column]):
+            try:
+                dataset_df[column] = dataset_df[column].astype(column_spec["dtype"])
+            except (TypeError, ValueError, OverflowError):
+                pass
+    return dataset_df
+
+def read_csv_pyarrow(dataset_path):
+    # typed read with the pyarrow csv reader, timestamps are only accepted in timestamp_format (the pandas pyarrow
+    # engine infers them first and accepts any ISO 8601 variant) - a value that does not convert raises like any
+    # other value of the wrong type
+    arrow_types = {"Int32": pyarrow.int32(), "float32": pyarrow.float32(), "float64": pyarrow.float64(), "datetime": pyarrow.timestamp("s")}
+    table = pyarrow.csv.read_csv(dataset_path, convert_options=pyarrow.csv.ConvertOptions(
+        include_columns=[column_spec["source"] for column_spec in dataset_columns],
+        column_types={column_spec["source"]: arrow_types[column_spec["dtype"]] for column_spec in dataset_columns},
+        timestamp_parsers=[timestamp_format],
+    ))
+    return table.to_pandas(types_mapper={pyarrow.int32(): pandas.Int32Dtype()}.get)
+
+def read_dataset(dataset_path, chunksize=None):
+    # typed read driven by the dataset schema - only the needed columns, compact dtypes, timestamps parsed once
+    dataset_path = str(Path(dataset_path).resolve(strict=False))
+    # timestamps are parsed with timestamp_format on every path - read as text and parsed by data_compact_dtypes,
+    # or parsed by the pyarrow csv reader itself
+    text_dtypes = {column_spec["source"]: "object" for column_spec in dataset_columns if column_spec["dtype"] == "datetime"}
+    read_options = {
+        "usecols": [column_spec["source"] for column_spec in dataset_columns],
+        "dtype": {
+            column_spec["source"]: "object" if column_spec["dtype"] == "datetime" else column_spec["dtype"] for column_spec in dataset_columns
+        },
+    }
+    if chunksize is not None:
+        # chunks are read untyped and cast afterwards - a bad value in a later chunk can not fail the whole read
+        reader = pandas.read_csv(dataset_path, usecols=read_options["usecols"], dtype=text_dtypes, chunksize=chunksize)
+        return (data_compact_dtypes(data_column_mapping(dataset_df)) for dataset_df in reader)
+
+    try:
+        dataset_df = read_csv_pyarrow(dataset_path) if pyarrow_available else pandas.read_csv(dataset_path, **read_options)
+    except (ValueError, KeyError) as e:
+        # missing columns or values of the wrong type - read everything untyped and let the validation report it
+        log_info("warning", f"Typed read failed for file {dataset_path} ({e}) | Reading untyped...")
+        dataset_df = pandas.read_csv(dataset_path, dtype=text_dtypes)
+    return data_compact_dtypes(data_column_mapping(dataset_df))
+
+def data_validation_split(dataset_df):
+    validation_check_dataset_df = data_validation(dataset_df)
     dataset_df = pandas.concat([dataset_df, validation_check_dataset_df], axis=1)
 
     valid_data_df = dataset_df[dataset_df['validity']==True]
     invalid_data_df = dataset_df[dataset_df['validity']==False]
+    metrics.increment("pipeline_rows_total", len(dataset_df))
+    metrics.increment("pipeline_valid_rows_total", len(valid_data_df))
+    metrics.increment("pipeline_invalid_rows_total", len(invalid_data_df))
 
     # logs
     log_info("info", 
@@ -175,17 +308,415 @@ def data_pre_processing(dataset_path):
     )
 
     # remove unnecessary columns
-    valid_data_df = valid_data_df.drop(columns=['validity', 'reason'])
+    valid_data_df = valid_data_df.drop(columns=['validity', 'reason', 'reason_code'])
+    # a timestamp column holding unparsed values only keeps parsed timestamps once the invalid rows are split off
+    for rule in timestamp_rules:
+        if rule["column"] in valid_data_df.columns and not pandas.api.types.is_datetime64_any_dtype(valid_data_df[rule["column"]]):
+            valid_data_df[rule["column"]] = pandas.to_datetime(valid_data_df[rule["column"]])
     valid_data_df = data_standardisation(valid_data_df)
+    return valid_data_df, invalid_data_df
+
+def combine_aggregated_data(aggregated_data):
+    # merge rows of the same sensor and file (eg: aggregates of several chunks) into one, exactly like the database does
+    group_columns = ["sensor_id", "source_file"]
+    grouped_data = aggregated_data.groupby(group_columns, sort=False)
+    combined_df = grouped_data.agg(
+        reading_count=("reading_count", "sum"),
+        min_timestamp=("min_timestamp", "min"),
+        max_timestamp=("max_timestamp", "max"),
+        min_pressure=("min_pressure", "min"),
+        max_pressure=("max_pressure", "max"),
+        sum_pressure=("sum_pressure", "sum"),
+        min_temperature=("min_temperature", "min"),
+        max_temperature=("max_temperature", "max"),
+        sum_temperature=("sum_temperature", "sum"),
+        min_humidity=("min_humidity", "min"),
+        max_humidity=("max_humidity", "max"),
+        sum_humidity=("sum_humidity", "sum"),
+        last_updated=("last_updated", "max"),
+    )
+    # M2 of the union - sum of the partial M2 plus the spread of the partial means around the combined mean
+    total_count = grouped_data["reading_count"].transform("sum")
+    for column in aggregated_metric_columns:
+        partial_mean = aggregated_data[f"sum_{column}"] / aggregated_data["reading_count"]
+        total_mean = grouped_data[f"sum_{column}"].transform("sum") / total_count
+        partial_m2 = aggregated_data[f"m2_{column}"] + aggregated_data["reading_count"] * (partial_mean - total_mean) ** 2
+        combined_df[f"m2_{column}"] = partial_m2.groupby([aggregated_data[group_column] for group_column in group_columns], sort=False).sum()
+    return combined_df.reset_index()
+
+def combine_rollup_data(rollup_data):
+    # merge rollup rows of the same bucket, sensor and file (eg: a bucket spanning two chunks)
+    group_columns = ["bucket", "sensor_id", "source_file", "bucket_start"]
+    aggregations = {"reading_count": "sum"}
+    for column in aggregated_metric_columns:
+        aggregations.update({f"min_{column}": "min", f"max_{column}": "max", f"sum_{column}": "sum", f"sum_sq_{column}": "sum"})
+    return rollup_data.groupby(group_columns, sort=False).agg(aggregations).reset_index()
+
+def drop_duplicate_rows(dataset_df, seen_row_hashes):
+    # duplicates across chunk boundaries - only the 64 bit hash of every row seen so far is kept, not the rows
+    # seen_row_hashes is a list of sorted runs, every chunk adds one and the last two runs are merged while the last
+    # one is at least half the size of the one before it, so there are only a few runs and a chunk costs a few
+    # searchsorted instead of a re-sort of every hash seen so far
+    row_hashes = pandas.util.hash_pandas_object(dataset_df, index=False).to_numpy()
+    # stable order - the first row of equal hashes stays first, like duplicated(), and sorted lookups stay in cache
+    order = numpy.argsort(row_hashes, kind="stable")
+    sorted_hashes = row_hashes[order]
+    sorted_duplicates = numpy.append(False, sorted_hashes[1:] == sorted_hashes[:-1])
+    for run in seen_row_hashes:
+        positions = numpy.minimum(numpy.searchsorted(run, sorted_hashes), len(run) - 1)
+        sorted_duplicates |= run[positions] == sorted_hashes
+
+    new_run = sorted_hashes[~sorted_duplicates]
+    if len(new_run):
+        seen_row_hashes.append(new_run)
+    while len(seen_row_hashes) > 1 and 2 * len(seen_row_hashes[-1]) >= len(seen_row_hashes[-2]):
+        merged_run = numpy.concatenate(seen_row_hashes[-2:])
+        # two sorted runs - the stable sort (timsort) merges them in about linear time
+        merged_run.sort(kind="stable")
+        seen_row_hashes[-2:] = [merged_run]
+
+    duplicate_mask = numpy.empty(len(row_hashes), dtype=bool)
+    duplicate_mask[order] = sorted_duplicates
+    return dataset_df[~duplicate_mask], seen_row_hashes
+
+def read_deduplicated_chunks(dataset_path):
+    # chunks of the file without the rows already seen in earlier chunks
+    seen_row_hashes = []
+    reader = read_dataset(dataset_path, chunksize=pipeline_config["chunk_rows"])
+    while True:
+        with metrics.timed_stage("read"):
+            dataset_df = next(reader, None)
+            if dataset_df is None:
+                return
+            dataset_df, seen_row_hashes = drop_duplicate_rows(dataset_df, seen_row_hashes)
+        yield dataset_df
+
+def data_streaming_processing(dataset_path):
+    ''' DATA PROCESSING IN FIXED SIZE CHUNKS - memory stays bounded by the chunk size for very large files '''
+    # no intermediate checkpoints here, a failed file is streamed again - raw writes are idempotent and the
+    # file lineage keeps the aggregates from being merged twice
+    # chunks are pipelined - chunk N+1 is read, validated and aggregated while chunk N is written to the database
+    log_info("info", f"Streaming Processing Started for file {dataset_path} (chunks of {pipeline_config['chunk_rows']} rows)")
+    processing_start_time = time.time()
+    # readings already stored are only left out of the aggregates on the first attempt, a retried file may find its
+    # own readings of the failed attempt stored and they still have to be counted (the file lineage merges them once)
+    processing_ledger = get_processing_ledger()
+    first_attempt = processing_ledger.get_stage(dataset_path) is None
+    if first_attempt:
+        processing_ledger.set_stage(dataset_path, "discovered")
+    quarantine_writer = get_quarantine_writer()
+    quarantine_futures = []
+    streaming_state = {"aggregated_data": None, "rollup_data": None, "total_rows": 0, "chunk_number": 0}
+
+    def prepare_chunk(dataset_df):
+        streaming_state["chunk_number"] += 1
+        streaming_state["total_rows"] += len(dataset_df)
+        chunk_number = streaming_state["chunk_number"]
+        with metrics.timed_stage("validation"):
+            valid_data_df, invalid_data_df = data_validation_split(dataset_df)
+
+        # written in the background, one part per chunk
+        quarantine_futures.append(quarantine_writer.submit(dataset_path, chunk_number, invalid_data_df))
+
+        # aggregates of the chunks are merged as they come, so only one row per sensor is kept in memory
+        new_data_df = data_new_readings(valid_data_df, db if first_attempt else None)
+        if not new_data_df.empty:
+            with metrics.timed_stage("aggregation"):
+                chunk_aggregated_data = data_post_processing(new_data_df, dataset_path)
+                chunk_rollup_data = data_rollup_processing(new_data_df, dataset_path)
+                if streaming_state["aggregated_data"] is not None:
+                    chunk_aggregated_data = combine_aggregated_data(pandas.concat([streaming_state["aggregated_data"], chunk_aggregated_data]))
+                    chunk_rollup_data = combine_rollup_data(pandas.concat([streaming_state["rollup_data"], chunk_rollup_data]))
+                streaming_state["aggregated_data"] = chunk_aggregated_data
+                streaming_state["rollup_data"] = chunk_rollup_data
+        return chunk_number, streaming_state["total_rows"], valid_data_df
+
+    def write_chunk(prepared_chunk):
+        chunk_number, total_rows, valid_data_df = prepared_chunk
+        if not valid_data_df.empty:
+            with metrics.timed_stage("raw_write"):
+                db.update_sensors(valid_data_df)
+                db.update_sensor_raw_data(valid_data_df)
+        log_info("info", f"Chunk {chunk_number} Completed for file {dataset_path} ({total_rows} rows so far)")
+
+    db = Database(db_config)
+    try:
+        db.connect()
+        PipelinedExecutor(prepare_chunk, write_chunk, pipeline_config["pipeline_queue_size"], "chunks").run(
+            read_deduplicated_chunks(dataset_path)
+        )
+
+        if streaming_state["aggregated_data"] is not None:
+            with metrics.timed_stage("aggregate_write"):
+                db.update_sensor_aggregated_metrics(streaming_state["aggregated_data"], streaming_state["rollup_data"])
+        with metrics.timed_stage("quarantine_write"):
+            wait_for_quarantine(quarantine_futures)
+    finally:
+        db.close()
 
-    invalid_data_df.to_csv("./quarantine/invalid_air_quality_data_part_1.csv", index=False)
+    total_rows = streaming_state["total_rows"]
+    processing_elapsed_time = time.time() - processing_start_time
+    log_info("info", f"Streaming Processing Completed for file {dataset_path} : {total_rows} rows in {processing_elapsed_time:.2f} seconds")
+    return total_rows
 
-    pre_processing_end_time = time.time()
-    pre_processing_elapsed_time = pre_processing_end_time - pre_processing_start_time
-    log_info("info", f"Pre-Processing Completed for file {dataset_path}")
+def data_pre_processing(dataset_path):
+    ''' DATA PRE-PROCESSING '''
+    # each completed stage is recorded in the processing ledger, a failed file resumes after its last completed stage
+    processing_ledger = get_processing_ledger()
+    if processing_ledger.has_completed(dataset_path, "completed"):
+        log_info("info", f"File {dataset_path} was already processed | Skipping...")
+        metrics.increment("pipeline_files_total", status="skipped")
+        return
+
+    file_start_time = time.perf_counter()
+    try:
+        # files above the streaming threshold are processed in chunks
+        if os.path.getsize(dataset_path) > pipeline_config["streaming_threshold_bytes"]:
+            total_rows = data_streaming_processing(dataset_path)
+        else:
+            total_rows = data_staged_processing(dataset_path, processing_ledger)
+    except Exception as e:
+        data_file_failed(dataset_path, e, processing_ledger)
+        raise
+
+    data_file_completed(dataset_path, total_rows, file_start_time, processing_ledger)
+
+def data_file_failed(dataset_path, error, processing_ledger):
+    processing_ledger.record_failure(dataset_path, error)
+    metrics.increment("pipeline_files_total", status="failed")
+
+def data_file_completed(dataset_path, total_rows, file_start_time, processing_ledger):
+    processing_ledger.set_stage(dataset_path, "completed")
+    processing_ledger.clear_checkpoints(dataset_path)
+
+    file_elapsed_time = time.perf_counter() - file_start_time
+    metrics.increment("pipeline_files_total", status="completed")
+    metrics.observe("pipeline_file_seconds", file_elapsed_time)
+    if file_elapsed_time > 0:
+        metrics.observe("pipeline_file_rows_per_second", total_rows / file_elapsed_time)
+
+def data_retry_processing(dataset_path, first_attempt=2):
+    # a failed file is retried in the foreground, every attempt resumes after the last completed stage
+    for attempt in range(first_attempt, pipeline_config["max_file_attempts"] + 1):
+        try:
+            data_pre_processing(dataset_path)
+            return True
+        except Exception as e:
+            log_info("error", f"Processing failed for file {dataset_path} (attempt {attempt}) : {e}")
+    return False
+
+def data_pipelined_processing(dataset_paths):
+    ''' PIPELINED FILE PROCESSING - file N+1 is read and validated while file N is aggregated and written to the database '''
+    processing_ledger = get_processing_ledger()
+
+    def prepare_file(dataset_path):
+        if processing_ledger.has_completed(dataset_path, "completed"):
+            log_info("info", f"File {dataset_path} was already processed | Skipping...")
+            metrics.increment("pipeline_files_total", status="skipped")
+            return dataset_path, None, None, None
+        file_start_time = time.perf_counter()
+        try:
+            # files above the streaming threshold pipeline their own chunks once it is their turn to be written
+            if os.path.getsize(dataset_path) > pipeline_config["streaming_threshold_bytes"]:
+                return dataset_path, file_start_time, None, None
+            return dataset_path, file_start_time, data_staged_prepare(dataset_path, processing_ledger), None
+        except Exception as e:
+            log_info("error", f"Processing failed for file {dataset_path} (attempt 1) : {e}")
+            data_file_failed(dataset_path, e, processing_ledger)
+            return dataset_path, file_start_time, None, e
+
+    def write_file(prepared_file):
+        dataset_path, file_start_time, prepared_data, error = prepared_file
+        if file_start_time is None:
+            return
+        if error is None:
+            try:
+                if prepared_data is None:
+                    total_rows = data_streaming_processing(dataset_path)
+                else:
+                    total_rows = data_staged_write(dataset_path, prepared_data, processing_ledger)
+                data_file_completed(dataset_path, total_rows, file_start_time, processing_ledger)
+                return
+            except Exception as e:
+                log_info("error", f"Processing failed for file {dataset_path} (attempt 1) : {e}")
+                data_file_failed(dataset_path, e, processing_ledger)
+
+        data_retry_processing(dataset_path)
+
+    PipelinedExecutor(prepare_file, write_file, pipeline_config["pipeline_queue_size"], "files").run(dataset_paths)
+
+def data_micro_batch_processing(dataset_paths):
+    ''' MICRO-BATCHING - small files arriving close together are validated, aggregated and written as one batch '''
+    # a batch is written once it reaches batch_max_rows rows or batch_max_files files, or batch_max_latency_seconds
+    # after its first file arrived - larger files are processed on their own
+    processing_ledger = get_processing_ledger()
+    arrived_files = queue.Queue(maxsize=pipeline_config["batch_max_files"])
+
+    def receive_files():
+        # file detection runs on its own thread so a batch can be flushed on time while no file arrives
+        try:
+            for dataset_path in dataset_paths:
+                arrived_files.put(dataset_path)
+            arrived_files.put(None)
+        except Exception as e:
+            arrived_files.put(e)
+    threading.Thread(target=receive_files, name="batch-receive", daemon=True).start()
+
+    batch = []
+    batch_rows = 0
+    batch_deadline = None
+    while True:
+        try:
+            timeout = max(0, batch_deadline - time.monotonic()) if batch else None
+            dataset_path = arrived_files.get(timeout=timeout)
+        except queue.Empty:
+            data_batch_write(batch, processing_ledger)
+            batch, batch_rows = [], 0
+            continue
+        if dataset_path is None or isinstance(dataset_path, Exception):
+            data_batch_write(batch, processing_ledger)
+            if isinstance(dataset_path, Exception):
+                raise dataset_path
+            return
+
+        if processing_ledger.has_completed(dataset_path, "completed"):
+            log_info("info", f"File {dataset_path} was already processed | Skipping...")
+            metrics.increment("pipeline_files_total", status="skipped")
+            continue
+        file_start_time = time.perf_counter()
+        oversized = False
+        try:
+            oversized = os.path.getsize(dataset_path) > pipeline_config["batch_max_file_bytes"]
+            if not oversized:
+                with metrics.timed_stage("read"):
+                    dataset_df = read_dataset(dataset_path).drop_duplicates()
+        except Exception as e:
+            log_info("error", f"Processing failed for file {dataset_path} (attempt 1) : {e}")
+            data_file_failed(dataset_path, e, processing_ledger)
+            data_retry_processing(dataset_path)
+            continue
+        if oversized:
+            # the pending batch is written first, it would otherwise wait for the whole large file past its deadline
+            data_batch_write(batch, processing_ledger)
+            batch, batch_rows = [], 0
+            data_retry_processing(dataset_path, first_attempt=1)
+            continue
+
+        if not batch:
+            batch_deadline = time.monotonic() + pipeline_config["batch_max_latency_seconds"]
+        batch.append((dataset_path, file_start_time, dataset_df))
+        batch_rows += len(dataset_df)
+        # the deadline is checked here as well, files arriving back to back (or a slow read) never leave the queue empty
+        if (batch_rows >= pipeline_config["batch_max_rows"] or len(batch) >= pipeline_config["batch_max_files"]
+                or time.monotonic() >= batch_deadline):
+            data_batch_write(batch, processing_ledger)
+            batch, batch_rows = [], 0
+
+def data_batch_write(batch, processing_ledger):
+    # validation and aggregation on the whole batch, one transaction for all database writes, the quarantine and the
+    # file lineage stay per file - a failed batch is split up and its files are retried one by one
+    if not batch:
+        return
+    log_info("info", f"Batch Processing Started for {len(batch)} files ({sum(len(dataset_df) for _, _, dataset_df in batch)} rows)")
+    batch_label = f"batch of {len(batch)} files"
+    try:
+        batch_df = pandas.concat(
+            [dataset_df.assign(source_file=dataset_path) for dataset_path, _, dataset_df in batch], ignore_index=True
+        )
+        batch_df["source_file"] = batch_df["source_file"].astype("category")
+        with metrics.timed_stage("validation"):
+            valid_data_df, invalid_data_df = data_validation_split(batch_df)
+
+        quarantine_writer = get_quarantine_writer()
+        quarantine_futures = [
+            quarantine_writer.submit(source_file, 0, invalid_file_df.drop(columns=["source_file"]))
+            for source_file, invalid_file_df in invalid_data_df.groupby("source_file", observed=True)
+        ]
+
+        db = Database(db_config)
+        try:
+            db.connect()
+            # the batch is written in one transaction, none of its readings can be stored by an earlier attempt
+            with metrics.timed_stage("aggregation"):
+                new_data_df = data_new_readings(valid_data_df, db)
+                aggregated_data = data_post_processing(new_data_df, batch_label)
+                rollup_data = data_rollup_processing(new_data_df, batch_label)
+            with metrics.timed_stage("batch_write"):
+                db.update_batch(valid_data_df, aggregated_data, rollup_data)
+        finally:
+            db.close()
+        with metrics.timed_stage("quarantine_write"):
+            wait_for_quarantine(quarantine_futures)
+    except Exception as e:
+        log_info("error", f"Processing failed for {batch_label} : {e} | Retrying files one by one...")
+        for dataset_path, _, _ in batch:
+            data_retry_processing(dataset_path, first_attempt=1)
+        return
+
+    for dataset_path, file_start_time, dataset_df in batch:
+        data_file_completed(dataset_path, len(dataset_df), file_start_time, processing_ledger)
+    log_info("info", f"Batch Processing Completed for {len(batch)} files")
+
+def data_staged_processing(dataset_path, processing_ledger):
+    prepared_data = data_staged_prepare(dataset_path, processing_ledger)
+    return data_staged_write(dataset_path, prepared_data, processing_ledger)
+
+def data_staged_prepare(dataset_path, processing_ledger):
+    # cpu side - read, validation and quarantine, resumed from the validated checkpoint when already done
+    pre_processing_elapsed_time = 0
+    if processing_ledger.has_completed(dataset_path, "validated"):
+        valid_data_df = processing_ledger.load_checkpoint(dataset_path, "validated")
+        total_rows = len(valid_data_df)
+        log_info("info", f"Resuming file {dataset_path} from validated checkpoint ({len(valid_data_df)} valid rows)")
+    else:
+        log_info("info", f"Pre-Processing Started for file {dataset_path}")
+        pre_processing_start_time = time.time()
+        with metrics.timed_stage("read"):
+            dataset_df = read_dataset(dataset_path).drop_duplicates()
+        total_rows = len(dataset_df)
+        with metrics.timed_stage("validation"):
+            valid_data_df, invalid_data_df = data_validation_split(dataset_df)
+
+        # the quarantine is written in the background while the validated checkpoint is saved, and is complete
+        # before the stage is recorded - a file resumed after validation never has to quarantine again
+        quarantine_future = get_quarantine_writer().submit(dataset_path, 0, invalid_data_df)
+        processing_ledger.save_checkpoint(dataset_path, "validated", valid_data_df)
+        with metrics.timed_stage("quarantine_write"):
+            wait_for_quarantine([quarantine_future])
+        processing_ledger.set_stage(dataset_path, "validated")
+
+        pre_processing_end_time = time.time()
+        pre_processing_elapsed_time = pre_processing_end_time - pre_processing_start_time
+        log_info("info", f"Pre-Processing Completed for file {dataset_path}")
 
-    # data analysis
-    aggregated_data = data_post_processing(valid_data_df, dataset_path)
+    log_info("info", f"Total time taken for pre-processing : {pre_processing_elapsed_time:.2f} seconds")
+    return valid_data_df, total_rows
+
+def data_staged_aggregate(dataset_path, valid_data_df, db, processing_ledger):
+    # aggregates and rollups of the readings the raw data write will insert - computed right before the raw write
+    # (after the files written before this one) and checkpointed before it, a file resumed after its raw write never
+    # finds its own readings stored and leaves them out
+    if processing_ledger.has_completed(dataset_path, "aggregated"):
+        aggregated_data = processing_ledger.load_checkpoint(dataset_path, "aggregated")
+        rollup_data = processing_ledger.load_checkpoint(dataset_path, "rollups")
+        if rollup_data is None:
+            # aggregates checkpointed without their rollups (older version), rebuilt from the same rows as them
+            rollup_data = data_rollup_processing(valid_data_df, dataset_path)
+        return aggregated_data, rollup_data
+
+    with metrics.timed_stage("aggregation"):
+        new_data_df = data_new_readings(valid_data_df, db)
+        aggregated_data = data_post_processing(new_data_df, dataset_path)
+        rollup_data = data_rollup_processing(new_data_df, dataset_path)
+    # rollups are checkpointed with the aggregates so both always describe the same rows
+    processing_ledger.save_checkpoint(dataset_path, "rollups", rollup_data)
+    processing_ledger.save_checkpoint(dataset_path, "aggregated", aggregated_data)
+    processing_ledger.set_stage(dataset_path, "aggregated")
+    return aggregated_data, rollup_data
+
+def data_staged_write(dataset_path, prepared_data, processing_ledger):
+    # i/o side - aggregation of the new readings, raw readings, aggregates and rollups written to the database
+    valid_data_df, total_rows = prepared_data
 
     # connect database and start write
     db_write_start_time = time.time()
@@ -193,14 +724,19 @@ def data_pre_processing(dataset_path):
     db = Database(db_config)
     try:
         db.connect()
-        db.create_tables()
-        db.update_sensor_raw_data(valid_data_df)
-        db.update_sensor_aggregated_metrics(aggregated_data)
+        aggregated_data, rollup_data = data_staged_aggregate(dataset_path, valid_data_df, db, processing_ledger)
+        if not processing_ledger.has_completed(dataset_path, "raw_written"):
+            with metrics.timed_stage("raw_write"):
+                db.update_sensors(valid_data_df)
+                db.update_sensor_raw_data(valid_data_df)
+            processing_ledger.set_stage(dataset_path, "raw_written")
+        with metrics.timed_stage("aggregate_write"):
+            db.update_sensor_aggregated_metrics(aggregated_data, rollup_data)
     finally:
         db.close()
     log_info("info", f"Database Write Completed for {dataset_path}")
     db_write_end_time = time.time()
     db_write_elapsed_time = db_write_end_time - db_write_start_time
 
-    log_info("info", f"Total time taken for pre-processing : {pre_processing_elapsed_time:.2f} seconds")
     log_info("info", f"Total time taken for database operations : {db_write_elapsed_time:.2f} seconds")
+    return total_rows
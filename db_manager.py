@@ -1,63 +1,233 @@
+import io
+import os
+import numpy
+import pandas
+import threading
+import time
+from datetime import datetime, timedelta
 import psycopg2
-import psycopg2.extras
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 from psycopg2 import OperationalError
 
-from utils.db_schema import query_create_sensor_raw_data, query_update_sensor_raw_data, query_create_sensor_aggregated_metrics, \
-    query_update_sensor_aggregated_metrics, query_fetch_sensor_aggregated_metrics
+from utils.db_schema import db_pool_config, query_create_sensor_raw_data, query_update_sensor_raw_data, query_create_sensor_aggregated_metrics, \
+    query_update_sensor_aggregated_metrics, query_fetch_sensor_aggregated_metrics, sensor_raw_data_columns, \
+    query_create_sensor_raw_data_staging, query_copy_sensor_raw_data_staging, \
+    query_create_sensor_aggregated_metrics_staging, query_copy_sensor_aggregated_metrics_staging, \
+    query_migrate_sensor_aggregated_metrics, query_create_sensor_file_lineage, query_update_sensor_file_lineage, \
+    query_migrate_sensor_aggregated_metrics_metadata, sensor_aggregated_metrics_staging_columns, \
+    query_create_sensor_raw_data_indexes, query_create_sensor_raw_data_partition_functions, \
+    query_create_sensor_raw_data_partitions, query_create_sensor_raw_data_partitions_ahead, query_drop_sensor_raw_data_partitions, \
+    query_migrate_sensor_raw_data_rename, query_migrate_sensor_raw_data_copy, query_fetch_sensor_raw_data, \
+    query_create_sensors, sensors_columns, query_create_sensors_staging, query_copy_sensors_staging, query_update_sensors, \
+    query_fetch_sensors, query_migrate_sensor_raw_data_location, query_migrate_sensor_raw_data_pressure, query_migrate_sensor_aggregated_metrics_location, \
+    query_create_sensor_rollup, sensor_rollup_staging_columns, query_create_sensor_rollup_staging, query_copy_sensor_rollup_staging, \
+    query_update_sensor_rollup, query_fetch_sensor_rollup, query_create_file_work_queue, query_migrate_file_work_queue_timestamps, \
+    query_register_files, query_claim_file, \
+    query_renew_file_leases, query_complete_file, query_fail_file, query_fetch_file_work_queue_status, \
+    query_fetch_sensor_raw_data_partitions, query_fetch_sensor_raw_data_partition_latest, query_copy_sensor_raw_data_keys, query_fetch_sensor_raw_data_compactable_partitions, \
+    query_lock_sensor_raw_data_partition, query_check_sensor_raw_data_partition, query_copy_sensor_raw_data_partition, \
+    query_truncate_sensor_raw_data_partition
+from utils.dedup_index import DedupIndex, KeyCopyBuffer
+from utils.raw_data_archive import raw_data_archive_dtypes
 from utils.log_config import log_info
+from utils.metrics import metrics
+from utils.pipeline_config import pipeline_config
+
+
+# process wide connection pool, shared by every Database object of the process
+connection_pool = None
+connection_pool_pid = None
+connection_pool_lock = threading.Lock()
+connection_last_used = {}
+schema_ready = False
+# months that already have a sensor_raw_data partition, the partition function is only called for new months
+known_raw_data_partitions = set()
+# sensor_id -> (location_id, latitude, longitude) as stored in the sensors table, loaded once per process
+known_sensors = None
+# readings already stored in sensor_raw_data (recent window), loaded once per process - see utils/dedup_index.py
+dedup_index = None
+
+# tenacity hook, called before every retry of a Database method
+def record_db_retry(retry_state):
+    metrics.increment("pipeline_db_retries_total", operation=retry_state.fn.__name__)
+
+def init_connection_pool(config, pool_config=db_pool_config):
+    global connection_pool, connection_pool_pid
+    with connection_pool_lock:
+        # a pool inherited from the parent process (worker processes) is dropped without closing,
+        # its sockets still belong to the parent
+        if connection_pool is not None and connection_pool_pid == os.getpid():
+            return connection_pool
+        connection_pool = ThreadedConnectionPool(pool_config["minconn"], pool_config["maxconn"], **config)
+        connection_pool_pid = os.getpid()
+        connection_last_used.clear()
+        log_info("info", f"Connection pool created (min: {pool_config['minconn']}, max: {pool_config['maxconn']}).")
+        return connection_pool
+
+def close_connection_pool():
+    global connection_pool, connection_pool_pid
+    with connection_pool_lock:
+        if connection_pool is not None and connection_pool_pid == os.getpid():
+            connection_pool.closeall()
+            log_info("info", "Connection pool closed.")
+        connection_pool = None
+        connection_pool_pid = None
+        connection_last_used.clear()
+
+def bootstrap_database(config):
+    # schema creation/migration runs once at pipeline startup instead of once per file
+    global schema_ready
+    init_connection_pool(config)
+    if schema_ready:
+        return
+    db = Database(config)
+    try:
+        db.connect()
+        db.create_tables()
+        # loaded before the workers are forked, they start with a copy instead of loading it again each
+        if pipeline_config["dedup_index"]:
+            db.warm_dedup_index()
+    finally:
+        db.close()
+    schema_ready = True
 
 
 class Database:
     def __init__(self, config):
         self.config = config
         self.connection = None
+        self.pending_raw_data_partitions = set()
+        self.pending_raw_data = None
 
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(5),
         retry=retry_if_exception_type(Exception),
-        reraise=True
+        reraise=True,
+        before_sleep=record_db_retry
     )
     def connect(self):
         try:
-            self.connection = psycopg2.connect(**self.config)
-            log_info("info", "Connected to PostgreSQL database successfully.")
+            self.acquire_connection()
+            log_info("debug", "Connection acquired from the pool.")
         except Exception as e:
             log_info("error", f"Failed to connect to the database: {e}")
             raise
 
+    def acquire_connection(self):
+        pool = init_connection_pool(self.config)
+        self.connection = pool.getconn()
+        if not self.is_healthy():
+            pool.putconn(self.connection, close=True)
+            self.connection = None
+            raise OperationalError("Pooled connection failed health check")
+
+    def is_healthy(self):
+        # connections idle for longer than the health check interval are probed before use
+        if self.connection.closed:
+            return False
+        idle_time = time.time() - connection_last_used.get(id(self.connection), 0)
+        if idle_time < db_pool_config["health_check_interval"]:
+            return True
+        try:
+            with self.connection.cursor() as cur:
+                cur.execute("SELECT 1;")
+            self.connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def cursor(self):
+        # reconnect-on-failure - a connection dropped by recover() is replaced on the next (retried) operation
+        if self.connection is None:
+            self.acquire_connection()
+        return self.connection.cursor()
+
+    def recover(self):
+        # rollback after a failed operation, a broken connection is dropped so the retry gets a fresh one
+        if self.connection is None:
+            return
+        try:
+            if not self.connection.closed:
+                self.connection.rollback()
+                return
+        except psycopg2.Error:
+            pass
+        log_info("warning", "Database connection lost | Reconnecting on retry...")
+        connection_pool.putconn(self.connection, close=True)
+        self.connection = None
+
+    @staticmethod
+    def copy_to_staging(cur, dataframe, columns, query_copy_staging):
+        # stream the frame as csv through COPY FROM STDIN - one round trip instead of one per row
+        buffer = io.StringIO()
+        dataframe.to_csv(buffer, columns=columns, index=False, header=False)
+        buffer.seek(0)
+        cur.copy_expert(query_copy_staging, buffer)
+
     def close(self):
         if self.connection:
-            self.connection.close()
-            log_info("info", "Database connection closed.")
+            connection_last_used[id(self.connection)] = time.time()
+            connection_pool.putconn(self.connection, close=bool(self.connection.closed))
+            self.connection = None
+            log_info("debug", "Database connection returned to the pool.")
 
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(5),
         retry=retry_if_exception_type(Exception),
-        reraise=True
+        reraise=True,
+        before_sleep=record_db_retry
     )
     def create_tables(self):
         try:
-            with self.connection.cursor() as cur:
-                # Create raw_sensor_data table
+            with self.cursor() as cur:
+                # Create sensors table (location data of every sensor)
+                cur.execute(query_create_sensors)
+
+                # Create raw_sensor_data table, partitioned by month with partitions created ahead of incoming data
+                cur.execute(query_migrate_sensor_raw_data_rename)
                 cur.execute(query_create_sensor_raw_data)
+                cur.execute(query_create_sensor_raw_data_partition_functions)
+                cur.execute(query_migrate_sensor_raw_data_copy)
+                cur.execute(query_migrate_sensor_raw_data_location)
+                cur.execute(query_migrate_sensor_raw_data_pressure)
+                cur.execute(query_create_sensor_raw_data_partitions_ahead, (pipeline_config["raw_data_partitions_ahead"],))
 
                 # Create aggregated_metrics table
                 cur.execute(query_create_sensor_aggregated_metrics)
+                cur.execute(query_migrate_sensor_aggregated_metrics)
+                cur.execute(query_migrate_sensor_aggregated_metrics_location)
+
+                # Create rollup tables, one per bucket size
+                for bucket in pipeline_config["rollup_buckets"]:
+                    cur.execute(sql.SQL(query_create_sensor_rollup).format(
+                        table=sql.Identifier(f"sensor_rollup_{bucket}"),
+                        index=sql.Identifier(f"idx_sensor_rollup_{bucket}_bucket_start"),
+                    ))
+
+                # Create file lineage table
+                cur.execute(query_create_sensor_file_lineage)
+                cur.execute(query_migrate_sensor_aggregated_metrics_metadata)
+
+                # Create file work queue table (coordinated mode)
+                cur.execute(query_create_file_work_queue)
+                cur.execute(query_migrate_file_work_queue_timestamps)
 
                 # Create indexes
+                cur.execute(query_create_sensor_raw_data_indexes)
                 cur.execute(
                     """
-                    CREATE INDEX IF NOT EXISTS idx_sensor_raw_data_timestamp
-                    ON sensor_raw_data (timestamp);
+                    CREATE INDEX IF NOT EXISTS idx_sensor_aggregated_metrics_sensor_id
+                    ON sensor_aggregated_metrics (sensor_id);
                     """
                 )
                 cur.execute(
                     """
-                    CREATE INDEX IF NOT EXISTS idx_sensor_aggregated_metrics_sensor_id
-                    ON sensor_aggregated_metrics (sensor_id);
+                    CREATE INDEX IF NOT EXISTS idx_sensor_file_lineage_source_file
+                    ON sensor_file_lineage (source_file);
                     """
                 )
 
@@ -65,68 +235,237 @@ class Database:
             log_info("info", "Tables created successfully (if not already present).")
         except Exception as e:
             log_info("error", f"Failed to create tables: {e}")
-            self.connection.rollback()
+            self.recover()
+            raise
+
+    @staticmethod
+    def sensor_signature(location_id, latitude, longitude):
+        return (int(location_id), round(float(latitude), 3), round(float(longitude), 3))
+
+    def write_sensors(self, cur, raw_data):
+        # only new sensors and sensors whose location changed are written, the rest is answered by the local cache
+        # returns the changed sensors, added to the cache by the caller once committed
+        global known_sensors
+        if known_sensors is None:
+            cur.execute(query_fetch_sensors)
+            known_sensors = {
+                sensor_id: self.sensor_signature(location_id, latitude, longitude)
+                for sensor_id, location_id, latitude, longitude in cur.fetchall()
+            }
+
+        sensors_data = raw_data.drop_duplicates("sensor_id", keep="last")[sensors_columns]
+        # compact float32 coordinates back to the 3 decimals of data_standardisation
+        sensors_data = sensors_data.astype({"latitude": "float64", "longitude": "float64"}).round({"latitude": 3, "longitude": 3})
+        sensor_signatures = {
+            int(sensor_id): self.sensor_signature(location_id, latitude, longitude)
+            for sensor_id, location_id, latitude, longitude in sensors_data.itertuples(index=False)
+        }
+        changed_sensors = {
+            sensor_id: signature for sensor_id, signature in sensor_signatures.items()
+            if known_sensors.get(sensor_id) != signature
+        }
+        if changed_sensors:
+            changed_sensors_data = sensors_data[sensors_data["sensor_id"].isin(list(changed_sensors))]
+            cur.execute(query_create_sensors_staging)
+            self.copy_to_staging(cur, changed_sensors_data, sensors_columns, query_copy_sensors_staging)
+            cur.execute(query_update_sensors)
+        return changed_sensors
+
+    def sensors_committed(self, changed_sensors):
+        known_sensors.update(changed_sensors)
+        if changed_sensors:
+            log_info("info", f"Sensors inserted/updated successfully. ({len(changed_sensors)} new or changed)")
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def update_sensors(self, raw_data):
+        try:
+            with self.cursor() as cur:
+                changed_sensors = self.write_sensors(cur, raw_data)
+            self.connection.commit()
+            self.sensors_committed(changed_sensors)
+        except Exception as e:
+            log_info("error", f"Failed to upsert sensors: {e}")
+            self.recover()
+            raise
+
+    def create_sensor_raw_data_partitions(self, cur, raw_data):
+        # partitions for the months of the incoming data, created in the same transaction as the insert
+        timestamps = pandas.to_datetime(raw_data["timestamp"])
+        months = set(timestamps.dt.to_period("M").dropna().unique())
+        self.pending_raw_data_partitions = months - known_raw_data_partitions
+        if self.pending_raw_data_partitions:
+            cur.execute(query_create_sensor_raw_data_partitions, (timestamps.min().to_pydatetime(), timestamps.max().to_pydatetime()))
+
+    def load_dedup_index(self, cur):
+        global dedup_index
+        index = DedupIndex(pipeline_config["dedup_window_seconds"])
+        # the newest partition holding rows gives the latest reading, partitions created ahead are empty
+        cur.execute(query_fetch_sensor_raw_data_partitions)
+        latest = None
+        for partition in [row[0] for row in cur.fetchall()]:
+            cur.execute(sql.SQL(query_fetch_sensor_raw_data_partition_latest).format(partition=sql.Identifier(partition)))
+            latest = cur.fetchone()[0]
+            if latest is not None:
+                break
+        key_buffer = KeyCopyBuffer()
+        if latest is not None:
+            cur.copy_expert(
+                sql.SQL(query_copy_sensor_raw_data_keys).format(
+                    window_start=sql.Literal(latest - pipeline_config["dedup_window_seconds"])
+                ),
+                key_buffer
+            )
+        index.load(latest, key_buffer.keys())
+        dedup_index = index
+        log_info("info", f"Dedup index loaded with {len(index)} readings.")
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def warm_dedup_index(self):
+        try:
+            with self.cursor() as cur:
+                self.load_dedup_index(cur)
+            self.connection.commit()
+        except Exception as e:
+            log_info("error", f"Failed to load the dedup index: {e}")
+            self.recover()
             raise
 
+    def known_sensor_raw_data(self, raw_data):
+        # boolean array, True for the readings the dedup index knows to be stored - all False with the index disabled
+        if not pipeline_config["dedup_index"]:
+            return numpy.zeros(len(raw_data), dtype=bool)
+        if dedup_index is None:
+            self.warm_dedup_index()
+        return dedup_index.known(raw_data)
+
+    def write_sensor_raw_data(self, cur, raw_data):
+        # returns the number of rows inserted, rows already stored are skipped - readings known to the dedup index
+        # are dropped here, the rest is left to ON CONFLICT
+        if pipeline_config["dedup_index"]:
+            if dedup_index is None:
+                self.load_dedup_index(cur)
+            known = dedup_index.known(raw_data)
+            if known.any():
+                metrics.increment("pipeline_dedup_skipped_rows_total", int(known.sum()))
+                raw_data = raw_data[~known]
+        self.pending_raw_data = raw_data
+        self.pending_raw_data_partitions = set()
+        if raw_data.empty:
+            return 0
+        cur.execute(query_create_sensor_raw_data_staging)
+        self.copy_to_staging(cur, raw_data, sensor_raw_data_columns, query_copy_sensor_raw_data_staging)
+        self.create_sensor_raw_data_partitions(cur, raw_data)
+        cur.execute(query_update_sensor_raw_data)
+        return cur.rowcount
+
+    def sensor_raw_data_committed(self, raw_data, inserted_rows):
+        known_raw_data_partitions.update(self.pending_raw_data_partitions)
+        # the rows sent are all stored now (inserted or already there)
+        if dedup_index is not None:
+            dedup_index.add(self.pending_raw_data)
+        self.pending_raw_data = None
+        log_info("info", f"Raw sensor data inserted/updated successfully. ({inserted_rows} new of {len(raw_data)} rows)")
+
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(5),
         retry=retry_if_exception_type(Exception),
-        reraise=True
+        reraise=True,
+        before_sleep=record_db_retry
     )
     def update_sensor_raw_data(self, raw_data):
         try:
-            with self.connection.cursor() as cur:
-                raw_data = raw_data.to_dict(orient='records')
-                for record in raw_data:
-                    cur.execute(query_update_sensor_raw_data, (
-                        record['sensor_id'], record['location_id'], record['latitude'],
-                        record['longitude'], record['timestamp'], record['pressure'],
-                        record['temperature'], record['humidity']
-                    ))
+            with self.cursor() as cur:
+                inserted_rows = self.write_sensor_raw_data(cur, raw_data)
             self.connection.commit()
-            log_info("info", "Raw sensor data inserted/updated successfully.")
+            self.sensor_raw_data_committed(raw_data, inserted_rows)
         except Exception as e:
             log_info("error", f"Failed to upsert raw data: {e}")
-            self.connection.rollback()
+            self.recover()
             raise
 
+    def write_sensor_aggregated_metrics(self, cur, aggregated_data, rollup_data=None):
+        cur.execute(query_create_sensor_aggregated_metrics_staging)
+        self.copy_to_staging(cur, aggregated_data, sensor_aggregated_metrics_staging_columns, query_copy_sensor_aggregated_metrics_staging)
+        cur.execute(query_update_sensor_file_lineage)
+        if cur.rowcount:
+            log_info("warning", f"Skipped {cur.rowcount} sensor aggregates already ingested from the same file.")
+        cur.execute(query_update_sensor_aggregated_metrics)
+
+        # rollups are merged in the same transaction, guarded by the same file lineage
+        if rollup_data is not None and not rollup_data.empty:
+            cur.execute(query_create_sensor_rollup_staging)
+            self.copy_to_staging(cur, rollup_data, sensor_rollup_staging_columns, query_copy_sensor_rollup_staging)
+            for bucket in rollup_data["bucket"].unique():
+                cur.execute(
+                    sql.SQL(query_update_sensor_rollup).format(table=sql.Identifier(f"sensor_rollup_{bucket}")),
+                    (bucket,)
+                )
+
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(5),
         retry=retry_if_exception_type(Exception),
-        reraise=True
+        reraise=True,
+        before_sleep=record_db_retry
     )
-    def update_sensor_aggregated_metrics(self, aggregated_data):
+    def update_sensor_aggregated_metrics(self, aggregated_data, rollup_data=None):
         try:
-            with self.connection.cursor() as cur:
-                aggregated_data = aggregated_data.to_dict(orient='records')
-                for record in aggregated_data:
-                    metadata_json = psycopg2.extras.Json(record['metadata'])
-                    cur.execute(query_update_sensor_aggregated_metrics, (
-                        record['sensor_id'], record['location_id'], record['latitude'],
-                        record['longitude'], record['min_pressure'], record['max_pressure'],
-                        record['avg_pressure'], record['std_pressure'], record['min_temperature'],
-                        record['max_temperature'], record['avg_temperature'], record['std_temperature'],
-                        record['min_humidity'], record['max_humidity'], record['avg_humidity'],
-                        record['std_humidity'], metadata_json
-                    ))
+            with self.cursor() as cur:
+                self.write_sensor_aggregated_metrics(cur, aggregated_data, rollup_data)
             self.connection.commit()
-            log_info("info", "Sensor aggregated metrics inserted/updated successfully.")
+            log_info("info", "Sensor aggregated metrics, rollups and file lineage inserted/updated successfully.")
         except Exception as e:
             log_info("error", f"Failed to upsert sensor aggregated metrics: {e}")
-            self.connection.rollback()
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def update_batch(self, raw_data, aggregated_data, rollup_data=None):
+        # micro-batch of several files - sensors, raw readings, aggregates, rollups and the file lineage in a single
+        # transaction (one commit for the whole batch), retried as a whole
+        try:
+            with self.cursor() as cur:
+                changed_sensors = self.write_sensors(cur, raw_data)
+                inserted_rows = self.write_sensor_raw_data(cur, raw_data)
+                self.write_sensor_aggregated_metrics(cur, aggregated_data, rollup_data)
+            self.connection.commit()
+            self.sensors_committed(changed_sensors)
+            self.sensor_raw_data_committed(raw_data, inserted_rows)
+            log_info("info", f"Batch of {aggregated_data['source_file'].nunique()} files written in one transaction.")
+        except Exception as e:
+            log_info("error", f"Failed to write batch: {e}")
+            self.recover()
             raise
 
     @retry(
         stop=stop_after_attempt(5),
         wait=wait_fixed(5),
         retry=retry_if_exception_type(Exception),
-        reraise=True
+        reraise=True,
+        before_sleep=record_db_retry
     )
     def fetch_sensor_aggregated_metrics(self, sensor_ids):
         try:
-            with self.connection.cursor() as cur:
+            with self.cursor() as cur:
                 cur.execute(query_fetch_sensor_aggregated_metrics, (sensor_ids,))
                 historical_data = cur.fetchall()
             self.connection.commit()
@@ -134,6 +473,261 @@ class Database:
             return historical_data
         except Exception as e:
             log_info("error", f"Failed to fetch sensor aggregated metrics: {e}")
-            self.connection.rollback()
+            self.recover()
+            raise
+ 
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def fetch_sensor_raw_data(self, sensor_id, start_time, end_time):
+        # the timestamp range lets postgres skip the partitions outside of it
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_fetch_sensor_raw_data, (sensor_id, start_time, end_time))
+                raw_data = cur.fetchall()
+            self.connection.commit()
+            return raw_data
+        except Exception as e:
+            log_info("error", f"Failed to fetch sensor raw data: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def fetch_sensor_rollup(self, bucket, sensor_id, start_time, end_time):
+        # bucket is one of the names in pipeline_config["rollup_buckets"], eg: "hourly"
+        try:
+            with self.cursor() as cur:
+                cur.execute(
+                    sql.SQL(query_fetch_sensor_rollup).format(table=sql.Identifier(f"sensor_rollup_{bucket}")),
+                    (sensor_id, start_time, end_time)
+                )
+                rollup_data = cur.fetchall()
+            self.connection.commit()
+            return rollup_data
+        except Exception as e:
+            log_info("error", f"Failed to fetch sensor rollup: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def drop_sensor_raw_data_partitions(self, cutoff):
+        # retention - whole monthly partitions older than the cutoff are dropped instead of a bulk DELETE
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_drop_sensor_raw_data_partitions, (cutoff,))
+                dropped_partitions = [row[0] for row in cur.fetchall()]
+            self.connection.commit()
+            known_raw_data_partitions.clear()
+            log_info("info", f"Dropped sensor raw data partitions : {dropped_partitions}")
+            return dropped_partitions
+        except Exception as e:
+            log_info("error", f"Failed to drop sensor raw data partitions: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def fetch_sensor_raw_data_compactable_partitions(self, cutoff):
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_fetch_sensor_raw_data_compactable_partitions, (cutoff,))
+                partitions = [row[0] for row in cur.fetchall()]
+            self.connection.commit()
+            return partitions
+        except Exception as e:
+            log_info("error", f"Failed to fetch compactable sensor raw data partitions: {e}")
+            self.recover()
+            raise
+
+    def export_sensor_raw_data_partition(self, cur, partition, start_time, end_time):
+        buffer = io.StringIO()
+        cur.copy_expert(
+            sql.SQL(query_copy_sensor_raw_data_partition).format(
+                partition=sql.Identifier(partition), start_time=sql.Literal(start_time), end_time=sql.Literal(end_time)
+            ),
+            buffer
+        )
+        buffer.seek(0)
+        raw_data = pandas.read_csv(
+            buffer, names=sensor_raw_data_columns, header=None,
+            dtype=raw_data_archive_dtypes
+        )
+        raw_data["timestamp"] = pandas.to_datetime(raw_data["timestamp"], format="ISO8601")
+        return raw_data
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def compact_sensor_raw_data_partition(self, partition, archive, run_id):
+        # one monthly partition, day by day - exported, written to the archive staging and verified, then published
+        # and the partition emptied, all under one lock so no reading is added or removed in between
+        # returns the number of archived readings
+        try:
+            archived_rows = 0
+            with self.cursor() as cur:
+                cur.execute(sql.SQL(query_lock_sensor_raw_data_partition).format(partition=sql.Identifier(partition)))
+                cur.execute(sql.SQL(query_check_sensor_raw_data_partition).format(partition=sql.Identifier(partition)))
+                if cur.fetchone()[0]:
+                    month_start = datetime.strptime(partition[-8:], "y%Ym%m")
+                    month_end = (month_start + timedelta(days=32)).replace(day=1)
+                    day = month_start
+                    while day < month_end:
+                        raw_data = self.export_sensor_raw_data_partition(cur, partition, day, day + timedelta(days=1))
+                        archive.write_staging(run_id, raw_data)
+                        archive.verify_staging(run_id, day, day + timedelta(days=1), raw_data)
+                        archived_rows += len(raw_data)
+                        day += timedelta(days=1)
+                    archive.publish_staging(run_id)
+                    cur.execute(sql.SQL(query_truncate_sensor_raw_data_partition).format(partition=sql.Identifier(partition)))
+            self.connection.commit()
+            log_info("info", f"Compacted sensor raw data partition {partition} ({archived_rows} readings archived)")
+            return archived_rows
+        except Exception as e:
+            log_info("error", f"Failed to compact sensor raw data partition {partition}: {e}")
+            # files already published stay, their readings are archived again by the retry (the reader drops the
+            # duplicates), only the staged files are removed
+            archive.discard_staging(run_id)
+            self.recover()
+            raise
+
+    # coordinated mode - files are claimed with leases in file_work_queue, so several nodes can share one data folder
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def register_files(self, file_names):
+        # files already registered (by this node or another one) are left as they are
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_register_files, (list(file_names),))
+                registered_files = cur.rowcount
+            self.connection.commit()
+            return registered_files
+        except Exception as e:
+            log_info("error", f"Failed to register files: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def claim_file(self, worker_id, lease_seconds, max_attempts):
+        # returns (file_name, attempts) of the claimed file, or None when no file is claimable
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_claim_file, {"worker_id": worker_id, "lease_seconds": lease_seconds, "max_attempts": max_attempts})
+                claimed_file = cur.fetchone()
+            self.connection.commit()
+            return claimed_file
+        except Exception as e:
+            log_info("error", f"Failed to claim a file: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def renew_file_leases(self, worker_id, file_names, lease_seconds):
+        # returns the files whose lease was renewed, a missing file was reclaimed by another node after its lease expired
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_renew_file_leases, {"worker_id": worker_id, "file_names": list(file_names), "lease_seconds": lease_seconds})
+                renewed_files = {row[0] for row in cur.fetchall()}
+            self.connection.commit()
+            return renewed_files
+        except Exception as e:
+            log_info("error", f"Failed to renew file leases: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def complete_file(self, worker_id, file_name):
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_complete_file, {"worker_id": worker_id, "file_name": file_name})
+            self.connection.commit()
+        except Exception as e:
+            log_info("error", f"Failed to mark file {file_name} as completed: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def fail_file(self, worker_id, file_name, error, max_attempts):
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_fail_file, {"worker_id": worker_id, "file_name": file_name, "error": error, "max_attempts": max_attempts})
+            self.connection.commit()
+        except Exception as e:
+            log_info("error", f"Failed to mark file {file_name} as failed: {e}")
+            self.recover()
+            raise
+
+    @retry(
+        stop=stop_after_attempt(5),
+        wait=wait_fixed(5),
+        retry=retry_if_exception_type(Exception),
+        reraise=True,
+        before_sleep=record_db_retry
+    )
+    def fetch_file_work_queue_status(self):
+        # number of files per status, eg: {"completed": 120, "claimed": 4, "pending": 10}
+        try:
+            with self.cursor() as cur:
+                cur.execute(query_fetch_file_work_queue_status)
+                status = dict(cur.fetchall())
+            self.connection.commit()
+            return status
+        except Exception as e:
+            log_info("error", f"Failed to fetch file work queue status: {e}")
+            self.recover()
             raise
- 
\ No newline at end of file
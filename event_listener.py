@@ -1,48 +1,279 @@
-import polling2
 import os
+import socket
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from tenacity import retry, stop_after_attempt, wait_fixed
 
-from data_processing import data_pre_processing
+from data_processing import data_pre_processing, data_pipelined_processing, data_micro_batch_processing
+from db_manager import Database, bootstrap_database, close_connection_pool
+from utils.db_schema import db_config
+from utils.file_watcher import create_file_watcher
 from utils.log_config import log_info
+from utils.metrics import metrics, start_metrics_server, start_metrics_dump
+from utils.pipeline_config import pipeline_config
+from utils.processing_ledger import get_processing_ledger
 
 
-def check_for_new_files(folder_path, known_files):
-    current_files = set(file for file in os.listdir(folder_path) if file.endswith('.csv'))
-    new_files = current_files - known_files
-    return new_files
+def process_file(dataset_path):
+    # runs in a worker process - a failing file is logged and reported, it never stops the other files
+    # every attempt resumes from the last stage completed by the previous one
+    # the metrics recorded by the worker for this file are returned with the result and merged by the observer
+    error = None
+    for attempt in range(1, pipeline_config["max_file_attempts"] + 1):
+        try:
+            data_pre_processing(dataset_path=dataset_path)
+            return True, None, metrics.collect_snapshot()
+        except Exception as e:
+            log_info("error", f"Processing failed for file {dataset_path} (attempt {attempt}) : {e}")
+            error = str(e)
+    return False, error, metrics.collect_snapshot()
+
+class WorkerPool:
+    # on_done(dataset_path, succeeded, error) is called on the observer thread once a file is finished
+    def __init__(self, worker_count, max_in_flight_files, on_done=None):
+        self.worker_count = worker_count
+        self.max_in_flight_files = max_in_flight_files
+        self.on_done = on_done
+        self.executor = ProcessPoolExecutor(max_workers=worker_count)
+        self.in_flight = {}
+
+    def wait_for_slot(self):
+        # backpressure - wait for a free slot before handing out more files
+        while len(self.in_flight) >= self.max_in_flight_files:
+            done, _ = wait(self.in_flight, return_when=FIRST_COMPLETED)
+            self.collect(done)
+
+    def submit(self, dataset_path):
+        self.wait_for_slot()
+        try:
+            future = self.executor.submit(process_file, dataset_path)
+        except BrokenProcessPool:
+            self.restart()
+            future = self.executor.submit(process_file, dataset_path)
+        self.in_flight[future] = dataset_path
+        self.collect_finished()
+
+    def collect_finished(self):
+        self.collect([future for future in self.in_flight if future.done()])
+
+    def collect(self, done):
+        for future in done:
+            dataset_path = self.in_flight.pop(future)
+            try:
+                succeeded, error, metrics_snapshot = future.result()
+                metrics.merge_snapshot(metrics_snapshot)
+                if succeeded:
+                    log_info("info", f"Worker finished file {dataset_path}")
+            except Exception as e:
+                # worker process died (eg: killed for memory) - only this file is affected
+                log_info("error", f"Worker failed for file {dataset_path} : {e}")
+                succeeded, error = False, str(e)
+            if self.on_done:
+                self.on_done(dataset_path, succeeded, error)
+        metrics.set_gauge("pipeline_in_flight_files", len(self.in_flight))
+
+    def restart(self):
+        log_info("warning", "Worker pool is broken | Restarting workers...")
+        self.collect_finished()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = ProcessPoolExecutor(max_workers=self.worker_count)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.collect(list(self.in_flight))
+
+def file_work_queue(operation, *args):
+    # one Database method call on file_work_queue with a pooled connection, eg: file_work_queue("claim_file", ...)
+    db = Database(db_config)
+    db.connect()
+    try:
+        return getattr(db, operation)(*args)
+    finally:
+        db.close()
+
+class FileCoordinator:
+    # coordinated mode - every node registers the files it sees in the shared data folder and claims them one at a
+    # time from file_work_queue (FOR UPDATE SKIP LOCKED, so two nodes never claim the same file)
+    # a claim is a lease renewed by a heartbeat thread while the file is processed, when a node crashes its leases
+    # expire and the files are claimed again by the other nodes
+    # a file processed twice after a lost lease is harmless - raw rows are written with ON CONFLICT DO NOTHING and the
+    # file lineage keeps the aggregates of a file from being merged twice
+    def __init__(self, worker_id, lease_seconds, max_file_claims):
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self.max_file_claims = max_file_claims
+        self.leased_files = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, name="lease-heartbeat", daemon=True)
+
+    def start(self):
+        self.heartbeat.start()
+        log_info("info", f"Coordinated processing as {self.worker_id} (lease: {self.lease_seconds} seconds)")
+
+    def stop(self):
+        self.stopping.set()
+        self.heartbeat.join(timeout=1)
+
+    def claim(self):
+        claimed_file = file_work_queue("claim_file", self.worker_id, self.lease_seconds, self.max_file_claims)
+        if claimed_file is None:
+            return None
+        file_name, claims = claimed_file
+        with self.lock:
+            self.leased_files.add(file_name)
+        log_info("info", f"Claimed file {file_name} (claim {claims} of {self.max_file_claims})")
+        return file_name
+
+    def file_done(self, dataset_path, succeeded, error):
+        file_name = os.path.basename(dataset_path)
+        with self.lock:
+            self.leased_files.discard(file_name)
+        if succeeded:
+            file_work_queue("complete_file", self.worker_id, file_name)
+        else:
+            file_work_queue("fail_file", self.worker_id, file_name, error, self.max_file_claims)
+
+    def renew_leases(self):
+        # every third of the lease time, a renewal can fail twice before the lease expires
+        while not self.stopping.wait(self.lease_seconds / 3):
+            with self.lock:
+                leased_files = set(self.leased_files)
+            if not leased_files:
+                continue
+            try:
+                renewed_files = file_work_queue("renew_file_leases", self.worker_id, leased_files, self.lease_seconds)
+            except Exception as e:
+                log_info("warning", f"Failed to renew file leases : {e}")
+                continue
+            with self.lock:
+                # files finished in the meantime are not reported as lost
+                lost_files = (leased_files - renewed_files) & self.leased_files
+            for file_name in sorted(lost_files):
+                log_info("warning", f"Lease lost for file {file_name} | It may be processed by another node as well")
 
 @retry(stop=stop_after_attempt(10), wait=wait_fixed(2))
 def start_observer():
-    folder_path = './data/'
+    folder_path = pipeline_config["data_folder"]
 
     if not os.path.exists(folder_path):
         log_info("info", f"Folder {folder_path} does not exist | Retrying...")
         raise Exception(f"Folder {folder_path} does not exist")
 
-    known_files = set(file for file in os.listdir(folder_path) if file.endswith('.csv'))
-    log_info("info", f"Found existing files : {known_files}")
+    # connection pool and schema are set up once, not per file
+    bootstrap_database(db_config)
+
+    existing_files = set(file for file in os.listdir(folder_path) if file.endswith('.csv'))
+    log_info("info", f"Found existing files : {existing_files}")
+
+    # existing files not completed according to the processing ledger (failed, interrupted or added while the
+    # observer was down) are resumed at startup - they are left out of known_files, so the file watcher hands them
+    # out like any other file found by a scan, once complete (a file may still be written while the observer starts)
+    processing_ledger = get_processing_ledger()
+    # files given up in an earlier run (eg: during a database outage) are retried, the skip only lasts until the next restart
+    given_up_files = processing_ledger.given_up_files(pipeline_config["max_file_attempts"])
+    if given_up_files:
+        log_info("warning", f"Retrying {len(given_up_files)} files given up in an earlier run : {sorted(given_up_files)}")
+    processing_ledger.reset_attempts()
+    completed_files = processing_ledger.completed_files()
+    known_files = set(file for file in existing_files if os.path.join(folder_path, file) in completed_files)
+    pending_files = existing_files - known_files
+
+    worker_pool = None
+    coordinator = None
+    if pipeline_config["processing_mode"] == "coordinated":
+        coordinator = FileCoordinator(
+            pipeline_config["worker_id"] or f"{socket.gethostname()}:{os.getpid()}",
+            pipeline_config["lease_seconds"],
+            pipeline_config["max_file_claims"],
+        )
+        coordinator.start()
+    if pipeline_config["processing_mode"] in ("worker_pool", "coordinated"):
+        worker_pool = WorkerPool(
+            pipeline_config["worker_count"], pipeline_config["max_in_flight_files"],
+            on_done=coordinator.file_done if coordinator else None
+        )
+        log_info("info", f"Processing files with {pipeline_config['worker_count']} workers")
 
-    while True:
+    def dispatch(each_file):
+        if worker_pool:
+            worker_pool.submit(os.path.join(folder_path, each_file))
+        else:
+            data_pre_processing(dataset_path=os.path.join(folder_path, each_file))
+
+    # files are dispatched as soon as they are completely written (inotify), polling is the fallback
+    file_watcher = create_file_watcher(
+        folder_path, known_files, pipeline_config["file_watcher"], pipeline_config["polling_interval"]
+    )
+
+    def detected_files():
+        if pending_files:
+            log_info("info", f"Resuming files not completed : {sorted(pending_files)}")
+        metrics.set_gauge("pipeline_pending_files", len(pending_files))
+        for each_file in file_watcher.watch():
+            if each_file in pending_files:
+                pending_files.discard(each_file)
+                metrics.set_gauge("pipeline_pending_files", len(pending_files))
+            else:
+                log_info("info", f"New file detected : {each_file}")
+            yield each_file
+
+    def register_files():
+        # coordinated mode - the completed files of the folder are registered at startup, the others and every new file
+        # once complete, the other nodes register the same files (ignored by file_work_queue)
         try:
-            new_files = polling2.poll(
-                lambda: check_for_new_files(folder_path, known_files),
-                step=5,  # polling interval
-                poll_forever=True
-            )
-            if new_files:
-                log_info("info", f"New files detected : {new_files}")
-                known_files.update(new_files)
-                for each_file in list(new_files):
-                    data_pre_processing(dataset_path=f"./data/{each_file}")
+            file_work_queue("register_files", sorted(known_files))
+            for each_file in file_watcher.watch():
+                log_info("info", f"New file detected : {each_file}")
+                file_work_queue("register_files", [each_file])
         except Exception as e:
-            log_info("error", f"Exception occured : {e} | Retrying... | Existing Files : {known_files}")
-            raise Exception(f"Exception occured : {e} | Retrying...")
+            log_info("error", f"File registration stopped : {e}")
+
+    try:
+        if pipeline_config["processing_mode"] == "coordinated":
+            registration = threading.Thread(target=register_files, name="file-registration", daemon=True)
+            registration.start()
+            while registration.is_alive():
+                worker_pool.wait_for_slot()
+                file_name = coordinator.claim()
+                if file_name is None:
+                    # nothing claimable - every file is done, claimed by a node or waiting for its lease to expire
+                    time.sleep(pipeline_config["claim_interval"])
+                    worker_pool.collect_finished()
+                    continue
+                worker_pool.submit(os.path.join(folder_path, file_name))
+            raise Exception("File registration stopped")
+        elif pipeline_config["processing_mode"] == "pipelined":
+            # detection and preparation run ahead on a background thread, database writes on this one
+            data_pipelined_processing(os.path.join(folder_path, each_file) for each_file in detected_files())
+        elif pipeline_config["processing_mode"] == "micro_batch":
+            data_micro_batch_processing(os.path.join(folder_path, each_file) for each_file in detected_files())
+        else:
+            for each_file in detected_files():
+                dispatch(each_file)
+    except Exception as e:
+        log_info("error", f"Exception occured : {e} | Retrying... | Existing Files : {known_files}")
+        raise Exception(f"Exception occured : {e} | Retrying...")
+    finally:
+        file_watcher.close()
+        if worker_pool:
+            worker_pool.shutdown()
+        if coordinator:
+            coordinator.stop()
 
 
 if __name__ == "__main__":
+    if pipeline_config["metrics_port"]:
+        start_metrics_server(pipeline_config["metrics_port"])
+    if pipeline_config["metrics_dump_path"]:
+        start_metrics_dump(pipeline_config["metrics_dump_path"], pipeline_config["metrics_dump_interval"])
     try:
         start_observer()
     except KeyboardInterrupt:
         log_info("error", f"Manually Interrupted | Observer is Stopping | Wait for few seconds")
     except Exception as e:
         log_info("error", f"Observer failed after multiple retries: {e}")
+    finally:
+        close_connection_pool()
@@ -0,0 +1,17 @@
+# columns read from every incoming dataset, anything else in the file (eg: unnamed index columns) is not loaded
+# - source: column name in the csv file
+# - column: column name used in the pipeline
+# - dtype : compact dtype the column is read as, "datetime" columns are parsed with timestamp_format
+dataset_columns = [
+    {"source": "sensor_id", "column": "sensor_id", "dtype": "Int32"},
+    {"source": "location", "column": "location_id", "dtype": "Int32"},
+    {"source": "lat", "column": "latitude", "dtype": "float32"},
+    {"source": "lon", "column": "longitude", "dtype": "float32"},
+    {"source": "timestamp", "column": "timestamp", "dtype": "datetime"},
+    # float32 keeps ~7 significant digits, not enough for pressure values with 2 decimals above 100k
+    {"source": "pressure", "column": "pressure", "dtype": "float64"},
+    {"source": "temperature", "column": "temperature", "dtype": "float32"},
+    {"source": "humidity", "column": "humidity", "dtype": "float32"},
+]
+
+timestamp_format = "%Y-%m-%dT%H:%M:%S"
@@ -5,84 +5,793 @@ db_config = {
         "port": 5432
     }
 
+# process wide connection pool - connections idle for longer than health_check_interval (seconds) are checked before use
+db_pool_config = {
+        "minconn": 1,
+        "maxconn": 5,
+        "health_check_interval": 30
+    }
+
+# static data of every sensor (location, latitude, longitude), kept once here instead of on every raw/aggregated row
+query_create_sensors = """
+        CREATE TABLE IF NOT EXISTS sensors (
+            sensor_id INT PRIMARY KEY,
+            location_id INT NOT NULL,
+            latitude FLOAT NOT NULL,
+            longitude FLOAT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """
+
+sensors_columns = ["sensor_id", "location_id", "latitude", "longitude"]
+
+query_create_sensors_staging = """
+        CREATE TEMP TABLE sensors_staging (
+            sensor_id INT,
+            location_id INT,
+            latitude FLOAT,
+            longitude FLOAT
+        ) ON COMMIT DROP;
+    """
+
+query_copy_sensors_staging = """
+        COPY sensors_staging (sensor_id, location_id, latitude, longitude)
+        FROM STDIN WITH (FORMAT csv);
+    """
+
+query_update_sensors = """
+        INSERT INTO sensors (sensor_id, location_id, latitude, longitude)
+        SELECT sensor_id, location_id, latitude, longitude
+        FROM sensors_staging
+        ORDER BY sensor_id
+        ON CONFLICT (sensor_id)
+        DO UPDATE SET
+            location_id = EXCLUDED.location_id,
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (sensors.location_id, sensors.latitude, sensors.longitude)
+            IS DISTINCT FROM (EXCLUDED.location_id, EXCLUDED.latitude, EXCLUDED.longitude);
+    """
+
+query_fetch_sensors = """
+        SELECT sensor_id, location_id, latitude, longitude FROM sensors;
+    """
+
+sensor_raw_data_columns = ["sensor_id", "timestamp", "pressure", "temperature", "humidity"]
+
+query_create_sensor_raw_data_staging = """
+        CREATE TEMP TABLE sensor_raw_data_staging (
+            sensor_id INT,
+            timestamp TIMESTAMP,
+            pressure FLOAT,
+            temperature REAL,
+            humidity REAL
+        ) ON COMMIT DROP;
+    """
+
+query_copy_sensor_raw_data_staging = """
+        COPY sensor_raw_data_staging (sensor_id, timestamp, pressure, temperature, humidity)
+        FROM STDIN WITH (FORMAT csv);
+    """
+
 query_update_sensor_raw_data = """
-        INSERT INTO sensor_raw_data (sensor_id, location_id, latitude, longitude, timestamp, pressure, temperature, humidity)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        INSERT INTO sensor_raw_data (sensor_id, timestamp, pressure, temperature, humidity)
+        SELECT sensor_id, timestamp, pressure, temperature, humidity
+        FROM sensor_raw_data_staging
+        ORDER BY sensor_id, timestamp -- same lock order in every worker, concurrent loads of overlapping files cannot deadlock
         ON CONFLICT (sensor_id, timestamp) DO NOTHING;
     """
 
+# dedup index warm up - the latest reading is taken from the newest monthly partition holding rows (there is no
+# b-tree on timestamp, MAX over the whole table would scan every partition), then the keys (sensor_id << 34 | epoch
+# seconds) of the readings in the window before it are streamed as binary COPY, sub-second timestamps cannot be
+# packed and are left out
+query_fetch_sensor_raw_data_partitions = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'sensor_raw_data' AND child.relname ~ '^sensor_raw_data_y[0-9]{4}m[0-9]{2}$'
+        ORDER BY child.relname DESC;
+    """
+
+query_fetch_sensor_raw_data_partition_latest = """
+        SELECT EXTRACT(EPOCH FROM MAX(timestamp))::BIGINT FROM {partition};
+    """
+
+query_copy_sensor_raw_data_keys = """
+        COPY (
+            SELECT (sensor_id::BIGINT << 34) | EXTRACT(EPOCH FROM timestamp)::BIGINT
+            FROM sensor_raw_data
+            WHERE timestamp >= TO_TIMESTAMP({window_start}) AT TIME ZONE 'UTC' AND timestamp = DATE_TRUNC('second', timestamp)
+        ) TO STDOUT WITH (FORMAT binary);
+    """
+
+# raw data is range partitioned by month on timestamp - queries on a time range only scan the matching partitions,
+# old data is removed by dropping whole partitions and every partition gets its own (small) indexes
+# rows are kept narrow - location data is in sensors, temperature and humidity are stored as REAL, pressure stays FLOAT
+# (REAL loses the 2nd decimal above 131072, pressure goes up to 165k)
 query_create_sensor_raw_data = """
         CREATE TABLE IF NOT EXISTS sensor_raw_data (
-            id SERIAL PRIMARY KEY,
             sensor_id INT NOT NULL,
-            location_id INT NOT NULL,
-            latitude FLOAT NOT NULL,
-            longitude FLOAT NOT NULL,
             timestamp TIMESTAMP NOT NULL,
             pressure FLOAT NOT NULL,
-            temperature FLOAT NOT NULL,
-            humidity FLOAT NOT NULL,
+            temperature REAL NOT NULL,
+            humidity REAL NOT NULL,
             UNIQUE(sensor_id, timestamp)
-        );
+        ) PARTITION BY RANGE (timestamp);
+    """
+
+# BRIN on the parent is created on every partition, readings arrive roughly in time order so it stays tiny
+query_create_sensor_raw_data_indexes = """
+        DROP INDEX IF EXISTS idx_sensor_raw_data_timestamp;
+        CREATE INDEX IF NOT EXISTS idx_sensor_raw_data_timestamp_brin
+        ON sensor_raw_data USING BRIN (timestamp);
+    """
+
+# monthly partitions named sensor_raw_data_yYYYYmMM, created when missing for every month in the given range
+query_create_sensor_raw_data_partition_functions = """
+        CREATE OR REPLACE FUNCTION create_sensor_raw_data_partitions(range_start TIMESTAMP, range_end TIMESTAMP)
+        RETURNS VOID AS $$
+        DECLARE
+            partition_start DATE := date_trunc('month', range_start)::date;
+            partition_name TEXT;
+        BEGIN
+            WHILE partition_start <= range_end LOOP
+                partition_name := 'sensor_raw_data_' || to_char(partition_start, '"y"YYYY"m"MM');
+                IF to_regclass(partition_name) IS NULL THEN
+                    EXECUTE format(
+                        'CREATE TABLE IF NOT EXISTS %I PARTITION OF sensor_raw_data FOR VALUES FROM (%L) TO (%L)',
+                        partition_name, partition_start, (partition_start + INTERVAL '1 month')::date
+                    );
+                END IF;
+                partition_start := (partition_start + INTERVAL '1 month')::date;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql;
+
+        CREATE OR REPLACE FUNCTION drop_sensor_raw_data_partitions(cutoff TIMESTAMP)
+        RETURNS SETOF TEXT AS $$
+        DECLARE
+            partition_name TEXT;
+        BEGIN
+            FOR partition_name IN
+                SELECT child.relname
+                FROM pg_inherits
+                JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+                JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+                WHERE parent.relname = 'sensor_raw_data' AND child.relname ~ '^sensor_raw_data_y[0-9]{4}m[0-9]{2}$'
+                ORDER BY child.relname
+            LOOP
+                -- only partitions whose whole month is before the cutoff
+                IF (to_date(right(partition_name, 8), '"y"YYYY"m"MM') + INTERVAL '1 month') <= cutoff THEN
+                    EXECUTE format('DROP TABLE %I', partition_name);
+                    RETURN NEXT partition_name;
+                END IF;
+            END LOOP;
+        END;
+        $$ LANGUAGE plpgsql;
+    """
+
+query_create_sensor_raw_data_partitions = """
+        SELECT create_sensor_raw_data_partitions(%s, %s);
+    """
+
+query_create_sensor_raw_data_partitions_ahead = """
+        SELECT create_sensor_raw_data_partitions(LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(months => %s));
+    """
+
+query_drop_sensor_raw_data_partitions = """
+        SELECT drop_sensor_raw_data_partitions(%s);
+    """
+
+# compaction - monthly partitions whose whole month is before the cutoff and that still hold rows
+query_fetch_sensor_raw_data_compactable_partitions = """
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'sensor_raw_data' AND child.relname ~ '^sensor_raw_data_y[0-9]{4}m[0-9]{2}$'
+            AND (to_date(right(child.relname, 8), '"y"YYYY"m"MM') + INTERVAL '1 month') <= %s
+        ORDER BY child.relname;
+    """
+
+# the partition is locked against writes for the whole compaction (reads go on), late readings for the month wait
+# and are inserted into the emptied partition afterwards
+query_lock_sensor_raw_data_partition = """
+        LOCK TABLE {partition} IN SHARE MODE;
+    """
+
+query_check_sensor_raw_data_partition = """
+        SELECT EXISTS (SELECT 1 FROM {partition});
+    """
+
+query_copy_sensor_raw_data_partition = """
+        COPY (
+            SELECT sensor_id, timestamp, pressure, temperature, humidity
+            FROM {partition}
+            WHERE timestamp >= {start_time} AND timestamp < {end_time}
+        ) TO STDOUT WITH (FORMAT csv);
+    """
+
+# TRUNCATE instead of DELETE - the space is given back at once and there are no dead rows left for vacuum
+query_truncate_sensor_raw_data_partition = """
+        TRUNCATE TABLE {partition};
+    """
+
+# tables created before partitioning - the plain table is renamed before the partitioned one is created...
+query_migrate_sensor_raw_data_rename = """
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('sensor_raw_data') AND relkind = 'r') THEN
+                ALTER TABLE sensor_raw_data RENAME TO sensor_raw_data_unpartitioned;
+            END IF;
+        END $$;
+    """
+
+# ...and its rows are moved into the partitions afterwards
+query_migrate_sensor_raw_data_copy = """
+        DO $$
+        DECLARE
+            range_start TIMESTAMP;
+            range_end TIMESTAMP;
+        BEGIN
+            IF to_regclass('sensor_raw_data_unpartitioned') IS NOT NULL THEN
+                SELECT MIN(timestamp), MAX(timestamp) INTO range_start, range_end FROM sensor_raw_data_unpartitioned;
+                PERFORM create_sensor_raw_data_partitions(range_start, range_end);
+
+                INSERT INTO sensors (sensor_id, location_id, latitude, longitude)
+                SELECT DISTINCT ON (sensor_id) sensor_id, location_id, latitude, longitude
+                FROM sensor_raw_data_unpartitioned
+                ORDER BY sensor_id, timestamp DESC
+                ON CONFLICT (sensor_id) DO NOTHING;
+
+                INSERT INTO sensor_raw_data (sensor_id, timestamp, pressure, temperature, humidity)
+                SELECT sensor_id, timestamp, pressure, temperature, humidity
+                FROM sensor_raw_data_unpartitioned
+                ON CONFLICT (sensor_id, timestamp) DO NOTHING;
+
+                DROP TABLE sensor_raw_data_unpartitioned;
+            END IF;
+        END $$;
+    """
+
+# partitioned tables created before the sensors table - location data moves to sensors, temperature and humidity
+# become REAL
+query_migrate_sensor_raw_data_location = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'sensor_raw_data' AND column_name = 'location_id'
+            ) THEN
+                INSERT INTO sensors (sensor_id, location_id, latitude, longitude)
+                SELECT DISTINCT ON (sensor_id) sensor_id, location_id, latitude, longitude
+                FROM sensor_raw_data
+                ORDER BY sensor_id, timestamp DESC
+                ON CONFLICT (sensor_id) DO NOTHING;
+
+                ALTER TABLE sensor_raw_data
+                    DROP COLUMN location_id,
+                    DROP COLUMN latitude,
+                    DROP COLUMN longitude,
+                    ALTER COLUMN temperature TYPE REAL,
+                    ALTER COLUMN humidity TYPE REAL;
+            END IF;
+        END $$;
+    """
+
+# tables migrated with pressure as REAL - back to FLOAT, the decimals already lost are not recovered
+query_migrate_sensor_raw_data_pressure = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'sensor_raw_data' AND column_name = 'pressure' AND data_type = 'real'
+            ) THEN
+                ALTER TABLE sensor_raw_data ALTER COLUMN pressure TYPE FLOAT;
+            END IF;
+        END $$;
+    """
+
+query_fetch_sensor_raw_data = """
+        SELECT sensor_id, timestamp, pressure, temperature, humidity
+        FROM sensor_raw_data
+        WHERE sensor_id = %s AND timestamp >= %s AND timestamp < %s
+        ORDER BY timestamp;
     """
 
+# aggregates keep sufficient statistics (count, sum and M2 - sum of squared deviations from the mean) per reading,
+# so two aggregates can be merged exactly (parallel variant of welford's algorithm) and avg/std are derived from them
 query_create_sensor_aggregated_metrics = """
         CREATE TABLE IF NOT EXISTS sensor_aggregated_metrics (
         sensor_id INT PRIMARY KEY,
-        location_id INT NOT NULL,
-        latitude FLOAT NOT NULL,
-        longitude FLOAT NOT NULL,
+        reading_count BIGINT NOT NULL,
         min_pressure FLOAT,
         max_pressure FLOAT,
-        avg_pressure FLOAT,
-        std_pressure FLOAT,
+        sum_pressure FLOAT,
+        m2_pressure FLOAT,
+        avg_pressure FLOAT GENERATED ALWAYS AS (ROUND((sum_pressure / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+        std_pressure FLOAT GENERATED ALWAYS AS (
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_pressure, 0) / (reading_count - 1))::numeric, 3)::float END
+        ) STORED,
         min_temperature FLOAT,
         max_temperature FLOAT,
-        avg_temperature FLOAT,
-        std_temperature FLOAT,
+        sum_temperature FLOAT,
+        m2_temperature FLOAT,
+        avg_temperature FLOAT GENERATED ALWAYS AS (ROUND((sum_temperature / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+        std_temperature FLOAT GENERATED ALWAYS AS (
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_temperature, 0) / (reading_count - 1))::numeric, 3)::float END
+        ) STORED,
         min_humidity FLOAT,
         max_humidity FLOAT,
-        avg_humidity FLOAT,
-        std_humidity FLOAT,
-        metadata JSONB NOT NULL,
+        sum_humidity FLOAT,
+        m2_humidity FLOAT,
+        avg_humidity FLOAT GENERATED ALWAYS AS (ROUND((sum_humidity / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+        std_humidity FLOAT GENERATED ALWAYS AS (
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_humidity, 0) / (reading_count - 1))::numeric, 3)::float END
+        ) STORED,
         last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
     """
 
+# tables created before the sufficient statistics were added - add the columns, backfill them from the raw data
+# and turn avg/std into columns derived from them
+query_migrate_sensor_aggregated_metrics = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'sensor_aggregated_metrics' AND column_name = 'avg_pressure' AND is_generated = 'NEVER'
+            ) THEN
+                ALTER TABLE sensor_aggregated_metrics
+                    ADD COLUMN IF NOT EXISTS reading_count BIGINT,
+                    ADD COLUMN IF NOT EXISTS sum_pressure FLOAT,
+                    ADD COLUMN IF NOT EXISTS m2_pressure FLOAT,
+                    ADD COLUMN IF NOT EXISTS sum_temperature FLOAT,
+                    ADD COLUMN IF NOT EXISTS m2_temperature FLOAT,
+                    ADD COLUMN IF NOT EXISTS sum_humidity FLOAT,
+                    ADD COLUMN IF NOT EXISTS m2_humidity FLOAT;
+
+                UPDATE sensor_aggregated_metrics AS aggregated
+                SET reading_count = COALESCE(raw.reading_count, 0),
+                    sum_pressure = COALESCE(raw.sum_pressure, 0),
+                    m2_pressure = COALESCE(raw.m2_pressure, 0),
+                    sum_temperature = COALESCE(raw.sum_temperature, 0),
+                    m2_temperature = COALESCE(raw.m2_temperature, 0),
+                    sum_humidity = COALESCE(raw.sum_humidity, 0),
+                    m2_humidity = COALESCE(raw.m2_humidity, 0)
+                FROM sensor_aggregated_metrics AS existing
+                LEFT JOIN (
+                    SELECT sensor_id, COUNT(*) AS reading_count,
+                        SUM(pressure) AS sum_pressure, VAR_POP(pressure) * COUNT(*) AS m2_pressure,
+                        SUM(temperature) AS sum_temperature, VAR_POP(temperature) * COUNT(*) AS m2_temperature,
+                        SUM(humidity) AS sum_humidity, VAR_POP(humidity) * COUNT(*) AS m2_humidity
+                    FROM sensor_raw_data
+                    GROUP BY sensor_id
+                ) AS raw ON raw.sensor_id = existing.sensor_id
+                WHERE aggregated.sensor_id = existing.sensor_id;
+
+                ALTER TABLE sensor_aggregated_metrics
+                    ALTER COLUMN reading_count SET NOT NULL,
+                    DROP COLUMN avg_pressure,
+                    DROP COLUMN std_pressure,
+                    DROP COLUMN avg_temperature,
+                    DROP COLUMN std_temperature,
+                    DROP COLUMN avg_humidity,
+                    DROP COLUMN std_humidity;
+
+                ALTER TABLE sensor_aggregated_metrics
+                    ADD COLUMN avg_pressure FLOAT GENERATED ALWAYS AS (ROUND((sum_pressure / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+                    ADD COLUMN std_pressure FLOAT GENERATED ALWAYS AS (
+                        CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_pressure, 0) / (reading_count - 1))::numeric, 3)::float END
+                    ) STORED,
+                    ADD COLUMN avg_temperature FLOAT GENERATED ALWAYS AS (ROUND((sum_temperature / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+                    ADD COLUMN std_temperature FLOAT GENERATED ALWAYS AS (
+                        CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_temperature, 0) / (reading_count - 1))::numeric, 3)::float END
+                    ) STORED,
+                    ADD COLUMN avg_humidity FLOAT GENERATED ALWAYS AS (ROUND((sum_humidity / NULLIF(reading_count, 0))::numeric, 3)::float) STORED,
+                    ADD COLUMN std_humidity FLOAT GENERATED ALWAYS AS (
+                        CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(m2_humidity, 0) / (reading_count - 1))::numeric, 3)::float END
+                    ) STORED;
+            END IF;
+        END $$;
+    """
+
+# tables created before the lineage table - move the per file readings kept in the metadata column into
+# sensor_file_lineage and drop the column, the readings themselves are still in sensor_raw_data
+query_migrate_sensor_aggregated_metrics_metadata = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'sensor_aggregated_metrics' AND column_name = 'metadata'
+            ) THEN
+                INSERT INTO sensor_file_lineage (sensor_id, source_file, row_count, min_timestamp, max_timestamp, ingested_at)
+                SELECT aggregated.sensor_id, source_file.key, COUNT(*),
+                    MIN((reading->>'timestamp')::timestamp), MAX((reading->>'timestamp')::timestamp), aggregated.last_updated
+                FROM sensor_aggregated_metrics AS aggregated,
+                    jsonb_each(aggregated.metadata) AS source_file,
+                    jsonb_array_elements(source_file.value) AS reading
+                GROUP BY aggregated.sensor_id, source_file.key, aggregated.last_updated
+                ON CONFLICT (sensor_id, source_file) DO NOTHING;
+
+                ALTER TABLE sensor_aggregated_metrics DROP COLUMN metadata;
+            END IF;
+        END $$;
+    """
+
+# tables created before the sensors table - location data moves to sensors (raw data wins, it is the more recent)
+query_migrate_sensor_aggregated_metrics_location = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'sensor_aggregated_metrics' AND column_name = 'location_id'
+            ) THEN
+                INSERT INTO sensors (sensor_id, location_id, latitude, longitude)
+                SELECT sensor_id, location_id, latitude, longitude
+                FROM sensor_aggregated_metrics
+                ON CONFLICT (sensor_id) DO NOTHING;
+
+                ALTER TABLE sensor_aggregated_metrics
+                    DROP COLUMN location_id,
+                    DROP COLUMN latitude,
+                    DROP COLUMN longitude;
+            END IF;
+        END $$;
+    """
+
+sensor_aggregated_metrics_columns = [
+    "sensor_id", "reading_count",
+    "min_pressure", "max_pressure", "sum_pressure", "m2_pressure",
+    "min_temperature", "max_temperature", "sum_temperature", "m2_temperature",
+    "min_humidity", "max_humidity", "sum_humidity", "m2_humidity"
+]
+
+sensor_aggregated_metrics_staging_columns = sensor_aggregated_metrics_columns + ["source_file", "min_timestamp", "max_timestamp"]
+
+query_create_sensor_aggregated_metrics_staging = """
+        CREATE TEMP TABLE sensor_aggregated_metrics_staging (
+            sensor_id INT,
+            reading_count BIGINT,
+            min_pressure FLOAT,
+            max_pressure FLOAT,
+            sum_pressure FLOAT,
+            m2_pressure FLOAT,
+            min_temperature FLOAT,
+            max_temperature FLOAT,
+            sum_temperature FLOAT,
+            m2_temperature FLOAT,
+            min_humidity FLOAT,
+            max_humidity FLOAT,
+            sum_humidity FLOAT,
+            m2_humidity FLOAT,
+            source_file TEXT,
+            min_timestamp TIMESTAMP,
+            max_timestamp TIMESTAMP
+        ) ON COMMIT DROP;
+    """
+
+query_copy_sensor_aggregated_metrics_staging = """
+        COPY sensor_aggregated_metrics_staging (
+            sensor_id, reading_count,
+            min_pressure, max_pressure, sum_pressure, m2_pressure,
+            min_temperature, max_temperature, sum_temperature, m2_temperature,
+            min_humidity, max_humidity, sum_humidity, m2_humidity,
+            source_file, min_timestamp, max_timestamp
+        )
+        FROM STDIN WITH (FORMAT csv);
+    """
+
+# one row per sensor and source file - which files contributed to the aggregates of a sensor
+query_create_sensor_file_lineage = """
+        CREATE TABLE IF NOT EXISTS sensor_file_lineage (
+            sensor_id INT NOT NULL,
+            source_file TEXT NOT NULL,
+            row_count INT NOT NULL,
+            min_timestamp TIMESTAMP NOT NULL,
+            max_timestamp TIMESTAMP NOT NULL,
+            ingested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sensor_id, source_file)
+        );
+    """
+
+# lineage is recorded in the same transaction as the aggregates, sensors of a file that was already ingested are removed
+# from the staging table so a re-delivered file is not merged into the aggregates twice
+query_update_sensor_file_lineage = """
+        WITH new_lineage AS (
+            INSERT INTO sensor_file_lineage (sensor_id, source_file, row_count, min_timestamp, max_timestamp)
+            SELECT sensor_id, source_file, reading_count, min_timestamp, max_timestamp
+            FROM sensor_aggregated_metrics_staging
+            ORDER BY sensor_id, source_file
+            ON CONFLICT (sensor_id, source_file) DO NOTHING
+            RETURNING sensor_id, source_file
+        )
+        DELETE FROM sensor_aggregated_metrics_staging AS staging
+        WHERE NOT EXISTS (
+            SELECT 1 FROM new_lineage
+            WHERE new_lineage.sensor_id = staging.sensor_id AND new_lineage.source_file = staging.source_file
+        );
+    """
+
+# merged in a single statement - the row lock taken by ON CONFLICT keeps concurrent merges of the same sensor consistent
+# staging rows of several files (micro-batches) are first merged per sensor the same way as combine_aggregated_data,
+# an INSERT .. ON CONFLICT DO UPDATE can not update the same row twice
 query_update_sensor_aggregated_metrics = """
         INSERT INTO sensor_aggregated_metrics (
-            sensor_id, location_id, latitude, longitude,
-            min_pressure, max_pressure, avg_pressure, std_pressure,
-            min_temperature, max_temperature, avg_temperature, std_temperature,
-            min_humidity, max_humidity, avg_humidity, std_humidity, metadata
+            sensor_id, reading_count,
+            min_pressure, max_pressure, sum_pressure, m2_pressure,
+            min_temperature, max_temperature, sum_temperature, m2_temperature,
+            min_humidity, max_humidity, sum_humidity, m2_humidity
         )
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        SELECT
+            sensor_id, SUM(reading_count),
+            MIN(min_pressure), MAX(max_pressure), SUM(sum_pressure),
+            SUM(m2_pressure + reading_count * POWER(sum_pressure / reading_count - mean_pressure, 2)),
+            MIN(min_temperature), MAX(max_temperature), SUM(sum_temperature),
+            SUM(m2_temperature + reading_count * POWER(sum_temperature / reading_count - mean_temperature, 2)),
+            MIN(min_humidity), MAX(max_humidity), SUM(sum_humidity),
+            SUM(m2_humidity + reading_count * POWER(sum_humidity / reading_count - mean_humidity, 2))
+        FROM (
+            SELECT *,
+                SUM(sum_pressure) OVER sensor / SUM(reading_count) OVER sensor AS mean_pressure,
+                SUM(sum_temperature) OVER sensor / SUM(reading_count) OVER sensor AS mean_temperature,
+                SUM(sum_humidity) OVER sensor / SUM(reading_count) OVER sensor AS mean_humidity
+            FROM sensor_aggregated_metrics_staging
+            WINDOW sensor AS (PARTITION BY sensor_id)
+        ) AS staging
+        GROUP BY sensor_id
+        ORDER BY sensor_id
         ON CONFLICT (sensor_id)
         DO UPDATE SET
-            location_id = EXCLUDED.location_id,
-            latitude = EXCLUDED.latitude,
-            longitude = EXCLUDED.longitude,
-            min_pressure = EXCLUDED.min_pressure,
-            max_pressure = EXCLUDED.max_pressure,
-            avg_pressure = EXCLUDED.avg_pressure,
-            std_pressure = EXCLUDED.std_pressure,
-            min_temperature = EXCLUDED.min_temperature,
-            max_temperature = EXCLUDED.max_temperature,
-            avg_temperature = EXCLUDED.avg_temperature,
-            std_temperature = EXCLUDED.std_temperature,
-            min_humidity = EXCLUDED.min_humidity,
-            max_humidity = EXCLUDED.max_humidity,
-            avg_humidity = EXCLUDED.avg_humidity,
-            std_humidity = EXCLUDED.std_humidity,
-            metadata = EXCLUDED.metadata || sensor_aggregated_metrics.metadata, -- Merging metadata
+            min_pressure = LEAST(sensor_aggregated_metrics.min_pressure, EXCLUDED.min_pressure),
+            max_pressure = GREATEST(sensor_aggregated_metrics.max_pressure, EXCLUDED.max_pressure),
+            sum_pressure = sensor_aggregated_metrics.sum_pressure + EXCLUDED.sum_pressure,
+            m2_pressure = sensor_aggregated_metrics.m2_pressure + EXCLUDED.m2_pressure + CASE WHEN sensor_aggregated_metrics.reading_count > 0 THEN
+                POWER(EXCLUDED.sum_pressure / EXCLUDED.reading_count - sensor_aggregated_metrics.sum_pressure / sensor_aggregated_metrics.reading_count, 2)
+                * sensor_aggregated_metrics.reading_count * EXCLUDED.reading_count / (sensor_aggregated_metrics.reading_count + EXCLUDED.reading_count)
+            ELSE 0 END,
+            min_temperature = LEAST(sensor_aggregated_metrics.min_temperature, EXCLUDED.min_temperature),
+            max_temperature = GREATEST(sensor_aggregated_metrics.max_temperature, EXCLUDED.max_temperature),
+            sum_temperature = sensor_aggregated_metrics.sum_temperature + EXCLUDED.sum_temperature,
+            m2_temperature = sensor_aggregated_metrics.m2_temperature + EXCLUDED.m2_temperature + CASE WHEN sensor_aggregated_metrics.reading_count > 0 THEN
+                POWER(EXCLUDED.sum_temperature / EXCLUDED.reading_count - sensor_aggregated_metrics.sum_temperature / sensor_aggregated_metrics.reading_count, 2)
+                * sensor_aggregated_metrics.reading_count * EXCLUDED.reading_count / (sensor_aggregated_metrics.reading_count + EXCLUDED.reading_count)
+            ELSE 0 END,
+            min_humidity = LEAST(sensor_aggregated_metrics.min_humidity, EXCLUDED.min_humidity),
+            max_humidity = GREATEST(sensor_aggregated_metrics.max_humidity, EXCLUDED.max_humidity),
+            sum_humidity = sensor_aggregated_metrics.sum_humidity + EXCLUDED.sum_humidity,
+            m2_humidity = sensor_aggregated_metrics.m2_humidity + EXCLUDED.m2_humidity + CASE WHEN sensor_aggregated_metrics.reading_count > 0 THEN
+                POWER(EXCLUDED.sum_humidity / EXCLUDED.reading_count - sensor_aggregated_metrics.sum_humidity / sensor_aggregated_metrics.reading_count, 2)
+                * sensor_aggregated_metrics.reading_count * EXCLUDED.reading_count / (sensor_aggregated_metrics.reading_count + EXCLUDED.reading_count)
+            ELSE 0 END,
+            reading_count = sensor_aggregated_metrics.reading_count + EXCLUDED.reading_count,
             last_updated = CURRENT_TIMESTAMP;
     """
 
+# per sensor time bucketed rollups (one table per bucket size in pipeline_config["rollup_buckets"], eg: sensor_rollup_hourly)
+# count/min/max/sum/sum of squares are additive, so later files overlapping the same buckets are merged incrementally
+# {table} is filled in with psycopg2.sql.Identifier
+query_create_sensor_rollup = """
+        CREATE TABLE IF NOT EXISTS {table} (
+            sensor_id INT NOT NULL,
+            bucket_start TIMESTAMP NOT NULL,
+            reading_count BIGINT NOT NULL,
+            min_pressure FLOAT,
+            max_pressure FLOAT,
+            sum_pressure FLOAT,
+            sum_sq_pressure FLOAT,
+            min_temperature FLOAT,
+            max_temperature FLOAT,
+            sum_temperature FLOAT,
+            sum_sq_temperature FLOAT,
+            min_humidity FLOAT,
+            max_humidity FLOAT,
+            sum_humidity FLOAT,
+            sum_sq_humidity FLOAT,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sensor_id, bucket_start)
+        );
+        CREATE INDEX IF NOT EXISTS {index} ON {table} USING BRIN (bucket_start);
+    """
+
+sensor_rollup_staging_columns = [
+    "bucket", "sensor_id", "source_file", "bucket_start", "reading_count",
+    "min_pressure", "max_pressure", "sum_pressure", "sum_sq_pressure",
+    "min_temperature", "max_temperature", "sum_temperature", "sum_sq_temperature",
+    "min_humidity", "max_humidity", "sum_humidity", "sum_sq_humidity"
+]
+
+query_create_sensor_rollup_staging = """
+        CREATE TEMP TABLE sensor_rollup_staging (
+            bucket TEXT,
+            sensor_id INT,
+            source_file TEXT,
+            bucket_start TIMESTAMP,
+            reading_count BIGINT,
+            min_pressure FLOAT,
+            max_pressure FLOAT,
+            sum_pressure FLOAT,
+            sum_sq_pressure FLOAT,
+            min_temperature FLOAT,
+            max_temperature FLOAT,
+            sum_temperature FLOAT,
+            sum_sq_temperature FLOAT,
+            min_humidity FLOAT,
+            max_humidity FLOAT,
+            sum_humidity FLOAT,
+            sum_sq_humidity FLOAT
+        ) ON COMMIT DROP;
+    """
+
+query_copy_sensor_rollup_staging = """
+        COPY sensor_rollup_staging (
+            bucket, sensor_id, source_file, bucket_start, reading_count,
+            min_pressure, max_pressure, sum_pressure, sum_sq_pressure,
+            min_temperature, max_temperature, sum_temperature, sum_sq_temperature,
+            min_humidity, max_humidity, sum_humidity, sum_sq_humidity
+        )
+        FROM STDIN WITH (FORMAT csv);
+    """
+
+# runs after query_update_sensor_file_lineage - only rollups of (sensor, file) pairs still in the aggregates staging table
+# (not ingested before) are merged, rows of several files falling in the same bucket are combined first
+query_update_sensor_rollup = """
+        INSERT INTO {table} (
+            sensor_id, bucket_start, reading_count,
+            min_pressure, max_pressure, sum_pressure, sum_sq_pressure,
+            min_temperature, max_temperature, sum_temperature, sum_sq_temperature,
+            min_humidity, max_humidity, sum_humidity, sum_sq_humidity
+        )
+        SELECT
+            sensor_id, bucket_start, SUM(reading_count),
+            MIN(min_pressure), MAX(max_pressure), SUM(sum_pressure), SUM(sum_sq_pressure),
+            MIN(min_temperature), MAX(max_temperature), SUM(sum_temperature), SUM(sum_sq_temperature),
+            MIN(min_humidity), MAX(max_humidity), SUM(sum_humidity), SUM(sum_sq_humidity)
+        FROM sensor_rollup_staging AS rollup
+        WHERE bucket = %s AND EXISTS (
+            SELECT 1 FROM sensor_aggregated_metrics_staging AS aggregated
+            WHERE aggregated.sensor_id = rollup.sensor_id AND aggregated.source_file = rollup.source_file
+        )
+        GROUP BY sensor_id, bucket_start
+        ORDER BY sensor_id, bucket_start
+        ON CONFLICT (sensor_id, bucket_start)
+        DO UPDATE SET
+            reading_count = {table}.reading_count + EXCLUDED.reading_count,
+            min_pressure = LEAST({table}.min_pressure, EXCLUDED.min_pressure),
+            max_pressure = GREATEST({table}.max_pressure, EXCLUDED.max_pressure),
+            sum_pressure = {table}.sum_pressure + EXCLUDED.sum_pressure,
+            sum_sq_pressure = {table}.sum_sq_pressure + EXCLUDED.sum_sq_pressure,
+            min_temperature = LEAST({table}.min_temperature, EXCLUDED.min_temperature),
+            max_temperature = GREATEST({table}.max_temperature, EXCLUDED.max_temperature),
+            sum_temperature = {table}.sum_temperature + EXCLUDED.sum_temperature,
+            sum_sq_temperature = {table}.sum_sq_temperature + EXCLUDED.sum_sq_temperature,
+            min_humidity = LEAST({table}.min_humidity, EXCLUDED.min_humidity),
+            max_humidity = GREATEST({table}.max_humidity, EXCLUDED.max_humidity),
+            sum_humidity = {table}.sum_humidity + EXCLUDED.sum_humidity,
+            sum_sq_humidity = {table}.sum_sq_humidity + EXCLUDED.sum_sq_humidity,
+            last_updated = CURRENT_TIMESTAMP;
+    """
+
+# windowed analytics read the rollups instead of the raw readings - avg and sample std derived from the sums
+query_fetch_sensor_rollup = """
+        SELECT sensor_id, bucket_start, reading_count,
+            min_pressure, max_pressure, ROUND((sum_pressure / reading_count)::NUMERIC, 3) AS avg_pressure,
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(sum_sq_pressure - sum_pressure ^ 2 / reading_count, 0) / (reading_count - 1))::NUMERIC, 3) END AS std_pressure,
+            min_temperature, max_temperature, ROUND((sum_temperature / reading_count)::NUMERIC, 3) AS avg_temperature,
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(sum_sq_temperature - sum_temperature ^ 2 / reading_count, 0) / (reading_count - 1))::NUMERIC, 3) END AS std_temperature,
+            min_humidity, max_humidity, ROUND((sum_humidity / reading_count)::NUMERIC, 3) AS avg_humidity,
+            CASE WHEN reading_count > 1 THEN ROUND(SQRT(GREATEST(sum_sq_humidity - sum_humidity ^ 2 / reading_count, 0) / (reading_count - 1))::NUMERIC, 3) END AS std_humidity
+        FROM {table}
+        WHERE sensor_id = %s AND bucket_start >= %s AND bucket_start < %s
+        ORDER BY bucket_start;
+    """
+
 query_fetch_sensor_aggregated_metrics = query = """
             SELECT sensor_id, location_id, latitude, longitude,
                 min_pressure, max_pressure, avg_pressure, std_pressure,
                 min_temperature, max_temperature, avg_temperature, std_temperature,
                 min_humidity, max_humidity, avg_humidity, std_humidity
             FROM sensor_aggregated_metrics
+            JOIN sensors USING (sensor_id)
             WHERE sensor_id = ANY(%s);
         """
+
+# coordinated mode - every file found in the shared data folder is registered here and claimed by one node at a time,
+# a claim is a lease that the node renews while it works on the file, leases of crashed nodes expire and are claimed
+# again by others, the table also keeps the processing status of every file
+query_create_file_work_queue = """
+        CREATE TABLE IF NOT EXISTS file_work_queue (
+            file_name TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            claimed_by TEXT,
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            discovered_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMPTZ,
+            lease_expires_at TIMESTAMPTZ,
+            completed_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS idx_file_work_queue_claimable
+        ON file_work_queue (discovered_at) WHERE status IN ('pending', 'claimed');
+    """
+
+# TIMESTAMPTZ - lease times are compared by every node, a plain TIMESTAMP would be filled in each session's time zone
+query_migrate_file_work_queue_timestamps = """
+        DO $$
+        BEGIN
+            IF EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'file_work_queue' AND column_name = 'lease_expires_at' AND data_type = 'timestamp without time zone'
+            ) THEN
+                ALTER TABLE file_work_queue
+                    ALTER COLUMN discovered_at TYPE TIMESTAMPTZ,
+                    ALTER COLUMN claimed_at TYPE TIMESTAMPTZ,
+                    ALTER COLUMN lease_expires_at TYPE TIMESTAMPTZ,
+                    ALTER COLUMN completed_at TYPE TIMESTAMPTZ;
+            END IF;
+        END $$;
+    """
+
+query_register_files = """
+        INSERT INTO file_work_queue (file_name)
+        SELECT UNNEST(%s::TEXT[])
+        ON CONFLICT (file_name) DO NOTHING;
+    """
+
+# the oldest pending file, or a claimed file whose lease expired - SKIP LOCKED lets concurrent nodes claim different
+# files without waiting on each other
+# an expired lease on the last allowed claim (the node crashed on it) is marked failed on the way, it would otherwise
+# stay claimed forever
+query_claim_file = """
+        WITH exhausted AS (
+            UPDATE file_work_queue
+            SET status = 'failed',
+                last_error = 'lease expired on the last allowed claim',
+                lease_expires_at = NULL
+            WHERE status = 'claimed' AND lease_expires_at < CURRENT_TIMESTAMP AND attempts >= %(max_attempts)s
+        )
+        UPDATE file_work_queue
+        SET status = 'claimed',
+            claimed_by = %(worker_id)s,
+            attempts = attempts + 1,
+            claimed_at = CURRENT_TIMESTAMP,
+            lease_expires_at = CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second'
+        WHERE file_name = (
+            SELECT file_name FROM file_work_queue
+            WHERE (status = 'pending' OR (status = 'claimed' AND lease_expires_at < CURRENT_TIMESTAMP))
+                AND attempts < %(max_attempts)s
+            ORDER BY discovered_at, file_name
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING file_name, attempts;
+    """
+
+query_renew_file_leases = """
+        UPDATE file_work_queue
+        SET lease_expires_at = CURRENT_TIMESTAMP + %(lease_seconds)s * INTERVAL '1 second'
+        WHERE file_name = ANY(%(file_names)s) AND claimed_by = %(worker_id)s AND status = 'claimed'
+        RETURNING file_name;
+    """
+
+query_complete_file = """
+        UPDATE file_work_queue
+        SET status = 'completed', completed_at = CURRENT_TIMESTAMP, lease_expires_at = NULL, last_error = NULL
+        WHERE file_name = %(file_name)s AND claimed_by = %(worker_id)s;
+    """
+
+# a failed file goes back to pending for another node, after max_attempts claims it is left as failed for inspection
+query_fail_file = """
+        UPDATE file_work_queue
+        SET status = CASE WHEN attempts >= %(max_attempts)s THEN 'failed' ELSE 'pending' END,
+            last_error = %(error)s,
+            lease_expires_at = NULL
+        WHERE file_name = %(file_name)s AND claimed_by = %(worker_id)s;
+    """
+
+query_fetch_file_work_queue_status = """
+        SELECT status, COUNT(*) FROM file_work_queue GROUP BY status ORDER BY status;
+    """
@@ -0,0 +1,170 @@
+import struct
+import threading
+
+import numpy
+
+
+# a reading key (sensor_id, timestamp) packed into one int64 - sensor_id << 34 | seconds since epoch
+# 34 bits of seconds last until the year 2514, sensor ids up to 2^29 fit in the remaining bits
+timestamp_bits = 34
+timestamp_mask = (1 << timestamp_bits) - 1
+
+
+def pack_reading_keys(sensor_ids, timestamps):
+    # returns the packed keys and whether each row could be packed exactly - rows with sub-second timestamps or
+    # before 1970 cannot, they are never answered by the index and always go to the database
+    seconds, remainder = numpy.divmod(timestamps.to_numpy(dtype="datetime64[ns]").astype("int64"), 1_000_000_000)
+    sensor_ids = sensor_ids.to_numpy(dtype="int64")
+    packable = (remainder == 0) & (seconds >= 0) & (seconds <= timestamp_mask) & (sensor_ids >= 0)
+    return (sensor_ids << timestamp_bits) | (seconds & timestamp_mask), packable
+
+
+class KeyCopyBuffer:
+    # file-like target for a binary COPY of one BIGINT column - the rows (2 bytes field count, 4 bytes length, 8 bytes
+    # value) are turned into int64 arrays every few MB as they arrive, the copy never sits in memory as text or tuples
+    copy_row = numpy.dtype([("fields", ">i2"), ("length", ">i4"), ("key", ">i8")])
+    copy_signature = b"PGCOPY\n\xff\r\n\0"
+
+    def __init__(self, flush_bytes=16 * 1024 * 1024):
+        self.flush_bytes = flush_bytes
+        self.pending = bytearray()
+        self.header_read = False
+        self.parts = []
+
+    def write(self, data):
+        self.pending += data
+        if len(self.pending) >= self.flush_bytes:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.header_read:
+            # signature, flags and header extension length, followed by the extension itself
+            if len(self.pending) < 19:
+                return
+            if bytes(self.pending[:11]) != self.copy_signature:
+                raise ValueError("Unexpected binary COPY header")
+            extension_length = struct.unpack(">i", self.pending[15:19])[0]
+            if len(self.pending) < 19 + extension_length:
+                return
+            del self.pending[:19 + extension_length]
+            self.header_read = True
+        row_count = len(self.pending) // self.copy_row.itemsize
+        if row_count:
+            rows = numpy.frombuffer(bytes(self.pending[:row_count * self.copy_row.itemsize]), dtype=self.copy_row)
+            # the trailer (field count -1) can only be the last 2 bytes, left in pending
+            self.parts.append(rows["key"].astype("int64"))
+            del self.pending[:row_count * self.copy_row.itemsize]
+
+    def keys(self):
+        self.flush()
+        if len(self.pending) not in (0, 2):
+            raise ValueError("Truncated binary COPY data")
+        return numpy.concatenate(self.parts) if self.parts else numpy.empty(0, dtype="int64")
+
+
+class DedupIndex:
+    # readings already stored in sensor_raw_data, so re-delivered or overlapping files do not send them to postgres
+    # only for ON CONFLICT DO NOTHING to throw them away
+    # - covered_from: every stored reading at or after this time (epoch seconds) is in the index, older readings are
+    #   unknown and always sent to the database (ON CONFLICT stays the final guard)
+    # - high_water_marks: latest indexed reading per sensor, a newer reading is new without looking at the keys
+    # - keys: sorted int64 arrays (one large run and a few small recent ones, merged from time to time), about
+    #   8 bytes per reading instead of ~70 for a python set
+    # the index only holds readings of the last window_seconds before the latest one, older keys are evicted
+    # a reading is only added once its transaction committed, the index never answers "known" for a row that is not
+    # stored (readings written by other processes are simply not known and left to ON CONFLICT)
+    def __init__(self, window_seconds, max_runs=8):
+        self.window_seconds = window_seconds
+        self.max_runs = max_runs
+        self.lock = threading.Lock()
+        self.covered_from = None
+        self.latest = None
+        self.high_water_marks = {}
+        self.runs = []
+
+    def load(self, latest, keys):
+        # keys of every stored reading in [latest - window_seconds, latest], latest is None for an empty table
+        with self.lock:
+            self.latest = latest
+            self.covered_from = 0 if latest is None else latest - self.window_seconds
+            # keys usually come in sensor order already, unique also sorts them when not
+            keys = numpy.unique(numpy.asarray(keys, dtype="int64"))
+            self.runs = [keys] if len(keys) else []
+            self.high_water_marks = {}
+            if len(keys):
+                # keys are sorted by sensor then time, the last key of every sensor is its high-water mark
+                sensor_ids = keys >> timestamp_bits
+                last_positions = numpy.flatnonzero(numpy.append(sensor_ids[1:] != sensor_ids[:-1], True))
+                self.high_water_marks = dict(zip(sensor_ids[last_positions].tolist(), (keys[last_positions] & timestamp_mask).tolist()))
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def known(self, raw_data):
+        # boolean array, True for the rows already stored
+        keys, packable = pack_reading_keys(raw_data["sensor_id"], raw_data["timestamp"])
+        known = numpy.zeros(len(keys), dtype=bool)
+        with self.lock:
+            if self.covered_from is None or not self.runs:
+                return known
+            seconds = keys & timestamp_mask
+            high_water_marks = high_water_marks_of(keys >> timestamp_bits, self.high_water_marks)
+            # only rows inside the covered window and not newer than their sensor's high-water mark can be known
+            candidates = packable & (seconds >= self.covered_from) & (seconds <= high_water_marks)
+            candidate_keys = keys[candidates]
+            candidate_known = numpy.zeros(len(candidate_keys), dtype=bool)
+            for run in self.runs:
+                positions = numpy.searchsorted(run, candidate_keys)
+                candidate_known |= run[numpy.minimum(positions, len(run) - 1)] == candidate_keys
+            known[candidates] = candidate_known
+        return known
+
+    def add(self, raw_data):
+        # readings committed to sensor_raw_data
+        keys, packable = pack_reading_keys(raw_data["sensor_id"], raw_data["timestamp"])
+        keys = numpy.unique(keys[packable])
+        if not len(keys):
+            return
+        with self.lock:
+            if self.covered_from is None:
+                return
+            keys = keys[(keys & timestamp_mask) >= self.covered_from]
+            if not len(keys):
+                return
+            sensor_ids = keys >> timestamp_bits
+            last_positions = numpy.flatnonzero(numpy.append(sensor_ids[1:] != sensor_ids[:-1], True))
+            for sensor_id, seconds in zip(sensor_ids[last_positions].tolist(), (keys[last_positions] & timestamp_mask).tolist()):
+                if seconds > self.high_water_marks.get(sensor_id, -1):
+                    self.high_water_marks[sensor_id] = seconds
+            latest = int((keys & timestamp_mask).max())
+            self.latest = latest if self.latest is None else max(self.latest, latest)
+
+            self.runs.append(keys)
+            if len(self.runs) > self.max_runs:
+                self.compact()
+
+    def compact(self):
+        # merges the runs into one and evicts the keys that left the window, the window start only moves forward
+        # once a quarter of the window has passed, so eviction does not run on every merge
+        keys = numpy.unique(numpy.concatenate(self.runs))
+        window_start = self.latest - self.window_seconds
+        if window_start - self.covered_from > self.window_seconds / 4:
+            keys = keys[(keys & timestamp_mask) >= window_start]
+            self.covered_from = window_start
+            self.high_water_marks = {
+                sensor_id: seconds for sensor_id, seconds in self.high_water_marks.items() if seconds >= window_start
+            }
+        self.runs = [keys] if len(keys) else []
+
+
+def high_water_marks_of(sensor_ids, high_water_marks):
+    # high-water mark of every row's sensor, -1 for sensors without readings in the index
+    if not high_water_marks:
+        return numpy.full(len(sensor_ids), -1, dtype="int64")
+    mark_sensor_ids = numpy.fromiter(high_water_marks.keys(), dtype="int64", count=len(high_water_marks))
+    mark_seconds = numpy.fromiter(high_water_marks.values(), dtype="int64", count=len(high_water_marks))
+    order = numpy.argsort(mark_sensor_ids)
+    mark_sensor_ids, mark_seconds = mark_sensor_ids[order], mark_seconds[order]
+    positions = numpy.minimum(numpy.searchsorted(mark_sensor_ids, sensor_ids), len(mark_sensor_ids) - 1)
+    return numpy.where(mark_sensor_ids[positions] == sensor_ids, mark_seconds[positions], -1)
@@ -0,0 +1,176 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+import polling2
+
+from utils.log_config import log_info
+
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def check_for_new_files(folder_path, known_files):
+    current_files = set(file for file in os.listdir(folder_path) if file.endswith('.csv'))
+    new_files = current_files - known_files
+    return new_files
+
+class SettlingFiles:
+    # files found by listing the folder (and not announced by a close-write or moved-to event) may still be written,
+    # such a file is complete once its size and modification time did not change for settle_seconds
+    def __init__(self, folder_path, settle_seconds):
+        self.folder_path = folder_path
+        self.settle_seconds = settle_seconds
+        # name -> ((size, mtime_ns), time it was first seen with them), None until the first check
+        self.signatures = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def add(self, names):
+        for name in names:
+            self.signatures.setdefault(name, None)
+
+    def discard(self, name):
+        self.signatures.pop(name, None)
+
+    def complete_files(self):
+        # complete files are handed out once and forgotten, as are files removed in the meantime
+        # the time is measured and not the number of checks, so back to back checks do not pass a file still written
+        complete_files = []
+        now = time.monotonic()
+        for name, last_signature in list(self.signatures.items()):
+            try:
+                file_stat = os.stat(os.path.join(self.folder_path, name))
+            except FileNotFoundError:
+                del self.signatures[name]
+                continue
+            signature = (file_stat.st_size, file_stat.st_mtime_ns)
+            if last_signature is None or last_signature[0] != signature:
+                self.signatures[name] = (signature, now)
+            elif now - last_signature[1] >= self.settle_seconds:
+                del self.signatures[name]
+                complete_files.append(name)
+        return sorted(complete_files)
+
+    def clear(self):
+        self.signatures.clear()
+
+def load_libc_inotify():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return libc
+
+
+class InotifyFileWatcher:
+    # event driven - a file is dispatched when the writer closes it (close-write) or when it is moved into the folder
+    # (moved-to, eg: written as a temp file and renamed), cost per event does not depend on the folder size
+    # files found by a scan instead (already there before the watch was added, or after the event queue overflowed)
+    # are dispatched on their event or once their size is stable for settle_seconds
+    def __init__(self, folder_path, known_files, libc, timeout=1, settle_seconds=5):
+        self.folder_path = folder_path
+        self.known_files = known_files
+        self.timeout = timeout
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        watch_descriptor = libc.inotify_add_watch(self.fd, os.fsencode(folder_path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch_descriptor < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder_path}")
+        # files not in known_files are rescanned now that the watch is in place - closed before the watch (no event)
+        # or still being written, they are only handed out once complete
+        self.settling_files = SettlingFiles(folder_path, settle_seconds)
+        self.settling_files.add(check_for_new_files(folder_path, known_files))
+
+    def read_events(self):
+        buffer = os.read(self.fd, 64 * 1024)
+        offset = 0
+        while offset < len(buffer):
+            _, mask, _, name_length = INOTIFY_EVENT_HEADER.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0").decode()
+            offset += name_length
+            yield mask, name
+
+    def watch(self):
+        while True:
+            new_files = self.settling_files.complete_files()
+            ready, _, _ = select.select([self.fd], [], [], self.timeout)
+            if ready:
+                for mask, name in self.read_events():
+                    if mask & IN_Q_OVERFLOW:
+                        # events were dropped by the kernel - fall back to a full scan once
+                        log_info("warning", "inotify event queue overflowed | Rescanning folder...")
+                        self.settling_files.add(check_for_new_files(self.folder_path, self.known_files))
+                    elif name.endswith(".csv"):
+                        # the event of a settling file is final, it does not wait for its size check
+                        self.settling_files.discard(name)
+                        new_files.append(name)
+            for name in new_files:
+                if name not in self.known_files:
+                    self.known_files.add(name)
+                    yield name
+
+    def close(self):
+        self.settling_files.clear()
+        os.close(self.fd)
+
+
+class PollingFileWatcher:
+    # fallback - the folder is listed every step seconds, a new file is dispatched once its size and modification
+    # time did not change for step seconds (two scans), so files still being written are not picked up
+    def __init__(self, folder_path, known_files, step=5):
+        self.folder_path = folder_path
+        self.known_files = known_files
+        self.step = step
+        self.settling_files = SettlingFiles(folder_path, step)
+
+    def check_for_complete_files(self):
+        self.settling_files.add(check_for_new_files(self.folder_path, self.known_files))
+        return self.settling_files.complete_files()
+
+    def watch(self):
+        while True:
+            new_files = polling2.poll(
+                self.check_for_complete_files,
+                step=self.step,  # polling interval
+                poll_forever=True
+            )
+            for name in new_files:
+                self.known_files.add(name)
+                yield name
+
+    def close(self):
+        self.settling_files.clear()
+
+
+def create_file_watcher(folder_path, known_files, backend="auto", step=5):
+    libc = load_libc_inotify() if backend in ("auto", "inotify") else None
+    if libc is not None:
+        try:
+            watcher = InotifyFileWatcher(folder_path, known_files, libc, settle_seconds=step)
+            log_info("info", f"Watching {folder_path} with inotify")
+            return watcher
+        except OSError as e:
+            log_info("warning", f"inotify is not available ({e}) | Falling back to polling")
+    elif backend == "inotify":
+        log_info("warning", "inotify is not supported on this platform | Falling back to polling")
+    log_info("info", f"Watching {folder_path} by polling every {step} seconds")
+    return PollingFileWatcher(folder_path, known_files, step)
@@ -1,10 +1,46 @@
+import atexit
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from multiprocessing.util import Finalize
+
+# log records are put on an in-memory queue and written to the console by a background listener thread, so the
+# pipeline never waits on the console - set up once per process (a forked worker sets up its own listener)
+log_listener = None
+log_listener_pid = None
+
+def setup_logging():
+    global log_listener, log_listener_pid
+    if log_listener_pid == os.getpid():
+        return
+    log_queue = queue.SimpleQueue()
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(logging.INFO)
+
+    log_listener = QueueListener(log_queue, console_handler, respect_handler_level=True)
+    log_listener.start()
+    log_listener_pid = os.getpid()
+    # worker processes exit without running atexit handlers, their queue is flushed by the multiprocessing finalizers
+    Finalize(None, stop_logging, exitpriority=0)
+
+def stop_logging():
+    # flushes the records still on the queue
+    global log_listener_pid
+    if log_listener is not None and log_listener_pid == os.getpid():
+        log_listener.stop()
+        log_listener_pid = None
+
+atexit.register(stop_logging)
 
 def log_info(log_type, log_message):
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(levelname)s - %(message)s',
-    )
+    setup_logging()
 
     if log_type == "info":
         logging.info(log_message)
@@ -0,0 +1,167 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.log_config import log_info
+
+
+latency_buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+throughput_buckets = [1_000, 5_000, 10_000, 50_000, 100_000, 250_000, 500_000, 1_000_000, 2_500_000, 5_000_000]
+
+# every metric the pipeline reports - type, help text and histogram buckets
+metric_definitions = {
+    "pipeline_files_total": {"type": "counter", "help": "Files handled by the pipeline by status"},
+    "pipeline_rows_total": {"type": "counter", "help": "Rows read from the files after deduplication"},
+    "pipeline_valid_rows_total": {"type": "counter", "help": "Rows that passed validation"},
+    "pipeline_invalid_rows_total": {"type": "counter", "help": "Rows quarantined by validation"},
+    "pipeline_db_retries_total": {"type": "counter", "help": "Database operations retried after a failure"},
+    "pipeline_dedup_skipped_rows_total": {"type": "counter", "help": "Rows dropped before the raw data write, already stored"},
+    "pipeline_stage_seconds": {"type": "histogram", "help": "Time spent per pipeline stage", "buckets": latency_buckets},
+    "pipeline_file_seconds": {"type": "histogram", "help": "Time spent per file", "buckets": latency_buckets},
+    "pipeline_file_rows_per_second": {"type": "histogram", "help": "Rows processed per second per file", "buckets": throughput_buckets},
+    "pipeline_pending_files": {"type": "gauge", "help": "Files detected and waiting to be dispatched"},
+    "pipeline_in_flight_files": {"type": "gauge", "help": "Files handed to the workers and not finished yet"},
+    "pipeline_queue_depth": {"type": "gauge", "help": "Prepared files or chunks waiting for the database write"},
+}
+
+
+class Metrics:
+    # in process registry - counters and histograms recorded in worker processes are sent back to the observer as
+    # snapshots and merged there, gauges are only set by the observer
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # a new lock as well - after a fork the old one may be held by a thread that does not exist in the child
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = metric_definitions[name]["buckets"]
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * (len(buckets) + 1), "sum": 0, "count": 0}
+            # per bucket counts, made cumulative when rendered - the last bucket is +Inf
+            histogram["buckets"][bisect.bisect_left(buckets, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    @contextmanager
+    def timed_stage(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("pipeline_stage_seconds", time.perf_counter() - start_time, stage=stage)
+
+    def collect_snapshot(self):
+        # counters and histograms recorded since the last snapshot, the registry starts over afterwards
+        with self.lock:
+            snapshot = {"counters": self.counters, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+        return snapshot
+
+    def merge_snapshot(self, snapshot):
+        with self.lock:
+            for key, value in snapshot["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in snapshot["histograms"].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = {"buckets": list(other["buckets"]), "sum": other["sum"], "count": other["count"]}
+                    continue
+                histogram["buckets"] = [count + other_count for count, other_count in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+    def render(self):
+        # prometheus text exposition format
+        with self.lock:
+            samples = {}
+            for (name, labels), value in sorted(list(self.counters.items()) + list(self.gauges.items())):
+                samples.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                lines = samples.setdefault(name, [])
+                cumulative_count = 0
+                for bound, count in zip(metric_definitions[name]["buckets"] + ["+Inf"], histogram["buckets"]):
+                    cumulative_count += count
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative_count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+        output = []
+        for name in sorted(samples):
+            output.append(f"# HELP {name} {metric_definitions[name]['help']}")
+            output.append(f"# TYPE {name} {metric_definitions[name]['type']}")
+            output.extend(samples[name])
+        return "\n".join(output) + "\n"
+
+    def dump(self, dump_path):
+        # written under a temp name and renamed, a reader never sees a half written file
+        with open(f"{dump_path}.tmp", "w") as dump_file:
+            dump_file.write(self.render())
+        os.replace(f"{dump_path}.tmp", dump_path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+
+metrics = Metrics()
+
+# a forked worker starts with an empty registry, values recorded by the parent before the fork are not sent twice
+os.register_at_fork(after_in_child=metrics.reset)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are not logged
+        pass
+
+def start_metrics_server(port, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    log_info("info", f"Metrics exposed on http://{host}:{port}/metrics")
+    return server
+
+def start_metrics_dump(dump_path, interval):
+    def dump_forever():
+        while True:
+            time.sleep(interval)
+            try:
+                metrics.dump(dump_path)
+            except OSError as e:
+                log_info("warning", f"Failed to dump metrics to {dump_path} : {e}")
+    threading.Thread(target=dump_forever, name="metrics-dump", daemon=True).start()
+    log_info("info", f"Metrics dumped to {dump_path} every {interval} seconds")
@@ -0,0 +1,63 @@
+import os
+
+pipeline_config = {
+        "data_folder": "./data/",
+        # "auto" - inotify on linux, polling elsewhere | "inotify" | "polling"
+        "file_watcher": "auto",
+        # seconds between two folder scans when polling
+        "polling_interval": 5,
+        # "sequential" - files are processed one by one in the observer process
+        # "worker_pool" - files are processed in parallel by worker processes
+        # "pipelined" - one process, the next file is read, validated and aggregated while the current one is written
+        # "micro_batch" - one process, small files arriving close together are written in a single transaction
+        # "coordinated" - several nodes share one data folder, each file is claimed by one node through the
+        #                 file_work_queue table and processed by its worker pool
+        "processing_mode": "worker_pool",
+        "worker_count": os.cpu_count() or 1,
+        # files submitted but not finished yet, the observer waits for a free slot above this (backpressure)
+        "max_in_flight_files": 2 * (os.cpu_count() or 1),
+        # files larger than this (bytes) are read, validated and written in chunks of chunk_rows rows
+        "streaming_threshold_bytes": 256 * 1024 * 1024,
+        "chunk_rows": 200_000,
+        # prepared files (pipelined mode) or chunks (streamed files) waiting for their database write, reading pauses
+        # above this until the database catches up
+        "pipeline_queue_size": 2,
+        # micro_batch mode - a batch is written at batch_max_rows rows or batch_max_files files, or at the latest
+        # batch_max_latency_seconds after its first file arrived, files above batch_max_file_bytes are not batched
+        "batch_max_rows": 200_000,
+        "batch_max_files": 50,
+        "batch_max_latency_seconds": 2.0,
+        "batch_max_file_bytes": 16 * 1024 * 1024,
+        # processing stage of every file and the intermediate results of completed stages, used to resume failed files
+        "ledger_path": "./checkpoints/processing_ledger.db",
+        "checkpoint_folder": "./checkpoints/",
+        # attempts per file without progress before it is left for the next restart (which retries it), each attempt resumes
+        # from the last completed stage
+        "max_file_attempts": 3,
+        # monthly sensor_raw_data partitions created ahead of the current month at startup
+        "raw_data_partitions_ahead": 3,
+        # readings already stored are dropped before the raw data write, the index holds the readings of the last
+        # dedup_window_seconds before the latest one (~8 bytes per reading), older readings are left to ON CONFLICT
+        "dedup_index": True,
+        "dedup_window_seconds": 7 * 24 * 3600,
+        # compactor.py - monthly sensor_raw_data partitions older than compaction_age_days are exported to parquet in
+        # archive_folder (archive_folder/date=<day>/sensor_id=<id>/), verified and emptied
+        "archive_folder": "./archive/",
+        "compaction_age_days": 90,
+        # invalid rows as parquet, one folder per source file
+        "quarantine_folder": "./quarantine/",
+        # time bucketed rollups computed at ingest, name (table sensor_rollup_<name>) -> pandas frequency of the bucket
+        "rollup_buckets": {"hourly": "1h", "daily": "1D"},
+        # prometheus text format metrics on http://127.0.0.1:<metrics_port>/metrics (None to disable), optionally also
+        # written to metrics_dump_path every metrics_dump_interval seconds
+        "metrics_port": 9108,
+        "metrics_dump_path": None,
+        "metrics_dump_interval": 30,
+        # coordinated mode - name of this node in file_work_queue (None: <host name>:<pid>), a claimed file is leased
+        # for lease_seconds and the lease is renewed while the file is processed, the lease of a crashed node expires
+        # and the file is claimed again by another node, up to max_file_claims claims per file
+        "worker_id": None,
+        "lease_seconds": 300,
+        "claim_interval": 1,
+        "max_file_claims": 3,
+    }
@@ -0,0 +1,58 @@
+import queue
+import threading
+
+from utils.log_config import log_info
+from utils.metrics import metrics
+
+
+class PipelinedExecutor:
+    # two stage pipeline - prepare (cpu: read, validate, aggregate) runs on a background thread and hands its results
+    # to write (i/o: database writes) on the calling thread through a bounded queue, so item N+1 is prepared while
+    # item N is written, prepare blocks once queue_size results are waiting (backpressure when the database is slow)
+    # psycopg2 and most of pandas release the gil, so both stages make progress at the same time
+    def __init__(self, prepare, write, queue_size, name):
+        self.prepare = prepare
+        self.write = write
+        self.name = name
+        self.prepared = queue.Queue(maxsize=queue_size)
+        self.stopping = threading.Event()
+
+    def put(self, entry):
+        # gives up when the writer stopped, a blocked put would otherwise keep the thread alive forever
+        while not self.stopping.is_set():
+            try:
+                self.prepared.put(entry, timeout=0.1)
+                metrics.set_gauge("pipeline_queue_depth", self.prepared.qsize(), queue=self.name)
+                return
+            except queue.Full:
+                continue
+
+    def produce(self, items):
+        try:
+            for item in items:
+                if self.stopping.is_set():
+                    return
+                self.put(("prepared", self.prepare(item)))
+        except BaseException as e:
+            self.put(("failed", e))
+        finally:
+            self.put(("finished", None))
+
+    def run(self, items):
+        producer = threading.Thread(target=self.produce, args=(items,), name=f"{self.name}-prepare", daemon=True)
+        producer.start()
+        try:
+            while True:
+                kind, value = self.prepared.get()
+                metrics.set_gauge("pipeline_queue_depth", self.prepared.qsize(), queue=self.name)
+                if kind == "finished":
+                    break
+                if kind == "failed":
+                    raise value
+                self.write(value)
+        finally:
+            self.stopping.set()
+            # a producer waiting on a source (eg: the file watcher) is a daemon thread and is not waited for
+            producer.join(timeout=1)
+            if producer.is_alive():
+                log_info("debug", f"{self.name} prepare thread still waiting for its source, left behind")
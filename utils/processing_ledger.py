@@ -0,0 +1,131 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+from contextlib import closing
+from datetime import datetime
+
+import pandas
+
+from utils.pipeline_config import pipeline_config
+
+
+# stages in the order they are completed, a file restarts from the stage after the last completed one
+STAGES = ["discovered", "validated", "aggregated", "raw_written", "completed"]
+
+query_create_processing_ledger = """
+        CREATE TABLE IF NOT EXISTS processing_ledger (
+            dataset_path TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at TEXT NOT NULL
+        );
+    """
+
+query_update_processing_ledger_stage = """
+        INSERT INTO processing_ledger (dataset_path, stage, updated_at)
+        VALUES (?, ?, ?)
+        ON CONFLICT (dataset_path) DO UPDATE SET
+            stage = excluded.stage,
+            attempts = 0,
+            error = NULL,
+            updated_at = excluded.updated_at;
+    """
+
+# attempts count the failures since the file last made progress in the current run, a new run starts them over
+query_reset_processing_ledger_attempts = """
+        UPDATE processing_ledger SET attempts = 0 WHERE stage != 'completed' AND attempts > 0;
+    """
+
+query_update_processing_ledger_failure = """
+        INSERT INTO processing_ledger (dataset_path, stage, attempts, error, updated_at)
+        VALUES (?, 'discovered', 1, ?, ?)
+        ON CONFLICT (dataset_path) DO UPDATE SET
+            attempts = processing_ledger.attempts + 1,
+            error = excluded.error,
+            updated_at = excluded.updated_at;
+    """
+
+
+class ProcessingLedger:
+    # durable local record of the processing stage of every file (sqlite, no extra service), with the intermediate
+    # results of the completed stages kept as parquet so a retry or restart resumes instead of starting over
+    def __init__(self, ledger_path, checkpoint_folder):
+        self.ledger_path = ledger_path
+        self.checkpoint_folder = checkpoint_folder
+        os.makedirs(checkpoint_folder, exist_ok=True)
+        with closing(self.connect()) as connection, connection:
+            connection.execute("PRAGMA journal_mode=WAL;")
+            connection.execute(query_create_processing_ledger)
+
+    def connect(self):
+        # short lived connections - the ledger is shared by the observer and the worker processes
+        return sqlite3.connect(self.ledger_path, timeout=30)
+
+    def get_stage(self, dataset_path):
+        with closing(self.connect()) as connection:
+            row = connection.execute(
+                "SELECT stage FROM processing_ledger WHERE dataset_path = ?;", (dataset_path,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def has_completed(self, dataset_path, stage):
+        current_stage = self.get_stage(dataset_path)
+        return current_stage is not None and STAGES.index(current_stage) >= STAGES.index(stage)
+
+    def set_stage(self, dataset_path, stage):
+        with closing(self.connect()) as connection, connection:
+            connection.execute(query_update_processing_ledger_stage, (dataset_path, stage, datetime.now().isoformat()))
+
+    def record_failure(self, dataset_path, error):
+        with closing(self.connect()) as connection, connection:
+            connection.execute(query_update_processing_ledger_failure, (dataset_path, str(error), datetime.now().isoformat()))
+
+    def reset_attempts(self):
+        # at startup - unfinished files get max_file_attempts again, their last error stays in the ledger
+        with closing(self.connect()) as connection, connection:
+            connection.execute(query_reset_processing_ledger_attempts)
+
+    def completed_files(self):
+        with closing(self.connect()) as connection:
+            rows = connection.execute("SELECT dataset_path FROM processing_ledger WHERE stage = 'completed';").fetchall()
+        return set(row[0] for row in rows)
+
+    def given_up_files(self, max_attempts):
+        # files that failed max_attempts times in this run without making progress, left in the ledger with their
+        # last error for inspection until the next restart
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                "SELECT dataset_path FROM processing_ledger WHERE stage != 'completed' AND attempts >= ?;", (max_attempts,)
+            ).fetchall()
+        return set(row[0] for row in rows)
+
+    def checkpoint_path(self, dataset_path, name):
+        file_key = hashlib.sha1(os.path.abspath(dataset_path).encode()).hexdigest()
+        return os.path.join(self.checkpoint_folder, file_key, f"{name}.parquet")
+
+    def save_checkpoint(self, dataset_path, name, dataset_df):
+        checkpoint_path = self.checkpoint_path(dataset_path, name)
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        # written under a temp name and renamed, a crash never leaves a half written checkpoint behind
+        dataset_df.to_parquet(f"{checkpoint_path}.tmp", index=False)
+        os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+
+    def load_checkpoint(self, dataset_path, name):
+        checkpoint_path = self.checkpoint_path(dataset_path, name)
+        if not os.path.exists(checkpoint_path):
+            return None
+        return pandas.read_parquet(checkpoint_path)
+
+    def clear_checkpoints(self, dataset_path):
+        shutil.rmtree(os.path.dirname(self.checkpoint_path(dataset_path, "")), ignore_errors=True)
+
+
+processing_ledger = None
+
+def get_processing_ledger():
+    global processing_ledger
+    if processing_ledger is None:
+        processing_ledger = ProcessingLedger(pipeline_config["ledger_path"], pipeline_config["checkpoint_folder"])
+    return processing_ledger
@@ -0,0 +1,92 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pandas
+
+from utils.log_config import log_info
+from utils.pipeline_config import pipeline_config
+from utils.validation_rules import reason_bits, decode_reason_code
+
+
+class QuarantineWriter:
+    # invalid rows are kept as parquet, one folder per source file (quarantine/source=<file name>/part-<n>.parquet),
+    # with the reason_code bitmask instead of the joined reason text - _reason_codes.json is the legend of the bits
+    # (names starting with "_" are skipped when the folder is read as one parquet dataset)
+    # writes run on a background thread, the caller only waits for them at the end of the file
+    def __init__(self, quarantine_folder):
+        self.quarantine_folder = quarantine_folder
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quarantine-writer")
+        os.makedirs(quarantine_folder, exist_ok=True)
+        self.write_legend()
+
+    def write_legend(self):
+        legend_path = os.path.join(self.quarantine_folder, "_reason_codes.json")
+        with open(f"{legend_path}.{os.getpid()}.tmp", "w") as legend_file:
+            json.dump({str(bit): reason for reason, bit in reason_bits.items()}, legend_file, indent=2)
+        os.replace(f"{legend_path}.{os.getpid()}.tmp", legend_path)
+
+    def part_path(self, dataset_path, part):
+        return os.path.join(self.quarantine_folder, f"source={Path(dataset_path).stem}", f"part-{part:05d}.parquet")
+
+    def write_part(self, dataset_path, part, invalid_data_df):
+        # a retried file writes the same part names again, so its quarantine is replaced and not duplicated
+        if invalid_data_df.empty:
+            return None
+        quarantine_df = invalid_data_df.drop(columns=["reason", "validity"], errors="ignore")
+        # values of the wrong type (eg: a string in a numeric column) are kept as text
+        object_columns = quarantine_df.select_dtypes(include=["object"]).columns
+        quarantine_df = quarantine_df.astype({column: "string" for column in object_columns})
+
+        part_path = self.part_path(dataset_path, part)
+        temp_path = os.path.join(os.path.dirname(part_path), f"_{os.path.basename(part_path)}.tmp")
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        quarantine_df.to_parquet(temp_path, index=False)
+        os.replace(temp_path, part_path)
+        return part_path
+
+    def submit(self, dataset_path, part, invalid_data_df):
+        return self.executor.submit(self.write_part, dataset_path, part, invalid_data_df)
+
+    def read(self, source=None):
+        # quarantined rows of one source file (file name without extension) or of all of them, with decoded reasons
+        # parts are read one by one, a file with values of the wrong type has text columns where others have numbers
+        source_folders = [f"source={source}"] if source else sorted(
+            name for name in os.listdir(self.quarantine_folder) if name.startswith("source=")
+        )
+        quarantine_parts = []
+        for source_folder in source_folders:
+            source_path = os.path.join(self.quarantine_folder, source_folder)
+            for name in sorted(os.listdir(source_path)) if os.path.isdir(source_path) else []:
+                if name.endswith(".parquet") and not name.startswith("_"):
+                    part_df = pandas.read_parquet(os.path.join(source_path, name))
+                    part_df["source"] = source_folder.split("=", 1)[1]
+                    quarantine_parts.append(part_df)
+        if not quarantine_parts:
+            return pandas.DataFrame()
+        quarantine_df = pandas.concat(quarantine_parts, ignore_index=True)
+        quarantine_df["reason"] = quarantine_df["reason_code"].map(
+            {code: decode_reason_code(code) for code in quarantine_df["reason_code"].unique()}
+        )
+        return quarantine_df
+
+
+def wait_for_quarantine(quarantine_futures):
+    # raises the error of a failed write, the file is then retried like for any other failed stage
+    for future in quarantine_futures:
+        part_path = future.result()
+        if part_path:
+            log_info("info", f"Quarantined rows written to {part_path}")
+
+
+quarantine_writer = None
+quarantine_writer_pid = None
+
+def get_quarantine_writer():
+    global quarantine_writer, quarantine_writer_pid
+    # one writer (and writer thread) per process, a forked worker does not inherit the parent's thread
+    if quarantine_writer is None or quarantine_writer_pid != os.getpid():
+        quarantine_writer = QuarantineWriter(pipeline_config["quarantine_folder"])
+        quarantine_writer_pid = os.getpid()
+    return quarantine_writer
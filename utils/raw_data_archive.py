@@ -0,0 +1,108 @@
+import os
+import shutil
+from datetime import timedelta
+
+import pandas
+import pyarrow
+import pyarrow.dataset
+import pyarrow.parquet
+
+from utils.log_config import log_info
+
+
+raw_data_archive_columns = ["sensor_id", "timestamp", "pressure", "temperature", "humidity"]
+# same precision as sensor_raw_data - pressure as float64 (float32 loses the 2nd decimal above 131072)
+raw_data_archive_dtypes = {"sensor_id": "int32", "pressure": "float64", "temperature": "float32", "humidity": "float32"}
+
+
+class RawDataArchive:
+    # cold sensor_raw_data readings as zstd compressed parquet, partitioned by day and sensor
+    # (archive/date=2017-07-01/sensor_id=1234/part-<run>-<n>.parquet), so a time range query for one sensor only
+    # opens the files of that sensor for the days in the range
+    # a compaction run writes its files under _staging/<run> first, they are verified there and only then moved
+    # into the archive (names starting with "_" are never read), every run has its own file names so a run never
+    # replaces the files of another one
+    def __init__(self, archive_folder):
+        self.archive_folder = archive_folder
+        os.makedirs(archive_folder, exist_ok=True)
+
+    def staging_path(self, run_id):
+        return os.path.join(self.archive_folder, "_staging", run_id)
+
+    def write_staging(self, run_id, raw_data_df):
+        if raw_data_df.empty:
+            return
+        archive_df = raw_data_df[raw_data_archive_columns].assign(date=raw_data_df["timestamp"].dt.strftime("%Y-%m-%d"))
+        pyarrow.parquet.write_to_dataset(
+            pyarrow.Table.from_pandas(archive_df, preserve_index=False),
+            self.staging_path(run_id),
+            partition_cols=["date", "sensor_id"],
+            basename_template=f"part-{run_id}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=1_000_000,
+            compression="zstd",
+        )
+
+    def read_staging(self, run_id, start_time, end_time):
+        # readings of the staged files in [start_time, end_time), read back from disk
+        if not os.path.isdir(self.staging_path(run_id)):
+            # nothing staged (eg: a day without readings), typed like the exported readings so the two compare equal
+            return normalise_raw_data(pandas.DataFrame(columns=raw_data_archive_columns))
+        staging = pyarrow.dataset.dataset(self.staging_path(run_id), format="parquet", partitioning="hive")
+        table = staging.to_table(
+            columns=raw_data_archive_columns,
+            filter=(pyarrow.dataset.field("timestamp") >= pyarrow.scalar(start_time, pyarrow.timestamp("us")))
+                & (pyarrow.dataset.field("timestamp") < pyarrow.scalar(end_time, pyarrow.timestamp("us"))),
+        )
+        return normalise_raw_data(table.to_pandas())
+
+    def verify_staging(self, run_id, start_time, end_time, raw_data_df):
+        # the staged files must give back exactly the exported readings, the database rows are only removed then
+        staged_df = self.read_staging(run_id, start_time, end_time)
+        if not sorted_raw_data(staged_df).equals(sorted_raw_data(normalise_raw_data(raw_data_df))):
+            raise ValueError(
+                f"Archive verification failed for {start_time:%Y-%m-%d} ({len(staged_df)} rows staged, {len(raw_data_df)} exported)"
+            )
+
+    def publish_staging(self, run_id):
+        staging_path = self.staging_path(run_id)
+        published_files = 0
+        for folder, _, file_names in os.walk(staging_path):
+            for file_name in file_names:
+                archive_folder = os.path.join(self.archive_folder, os.path.relpath(folder, staging_path))
+                os.makedirs(archive_folder, exist_ok=True)
+                os.replace(os.path.join(folder, file_name), os.path.join(archive_folder, file_name))
+                published_files += 1
+        self.discard_staging(run_id)
+        log_info("info", f"Published {published_files} archive files of run {run_id}")
+
+    def discard_staging(self, run_id):
+        shutil.rmtree(self.staging_path(run_id), ignore_errors=True)
+
+    def read(self, sensor_id, start_time, end_time):
+        # archived readings of one sensor in [start_time, end_time), sorted by timestamp
+        archive_parts = []
+        day = pandas.Timestamp(start_time).normalize()
+        while day < pandas.Timestamp(end_time):
+            sensor_folder = os.path.join(self.archive_folder, f"date={day:%Y-%m-%d}", f"sensor_id={sensor_id}")
+            for file_name in sorted(os.listdir(sensor_folder)) if os.path.isdir(sensor_folder) else []:
+                if file_name.endswith(".parquet") and not file_name.startswith("_"):
+                    archive_parts.append(pandas.read_parquet(os.path.join(sensor_folder, file_name)))
+            day += timedelta(days=1)
+        if not archive_parts:
+            return pandas.DataFrame(columns=raw_data_archive_columns)
+
+        archive_df = pandas.concat(archive_parts, ignore_index=True).assign(sensor_id=sensor_id)
+        archive_df = normalise_raw_data(archive_df)
+        archive_df = archive_df[(archive_df["timestamp"] >= start_time) & (archive_df["timestamp"] < end_time)]
+        # a run interrupted after publishing its files archives its readings again on the next run
+        return archive_df.drop_duplicates(["timestamp"]).sort_values("timestamp", ignore_index=True)
+
+
+def normalise_raw_data(raw_data_df):
+    return raw_data_df[raw_data_archive_columns].astype(
+        dict(raw_data_archive_dtypes, timestamp="datetime64[ns]")
+    ).reset_index(drop=True)
+
+def sorted_raw_data(raw_data_df):
+    return raw_data_df.sort_values(["sensor_id", "timestamp"], ignore_index=True)
@@ -0,0 +1,55 @@
+from utils.dataset_schema import timestamp_format
+
+
+# validation rules applied column-wise on every incoming dataset
+# - column      : column name after renaming (lat -> latitude, lon -> longitude, location -> location_id)
+# - numeric     : value must be numeric (int/float)
+# - type_bit    : bit of the data type reason in the reason_code bitmask, None if numeric is False
+# - min / max   : inclusive valid range, None if no range check is done
+# - range_reason: reason added to the row when the value is out of range
+# - range_bit   : bit of range_reason in the reason_code bitmask, None if range_reason is None
+# bits are stored with quarantined rows, so they are permanent - a new rule or reason takes the next unused bit and
+# the bit of a removed one is never given to another
+# order of the list is the order in which the reasons are reported
+validation_rules = [
+    # valid pressure range can be added if known, but not added here since the unit is unknown (0 to 165k range mentioned in dataset)
+    {"column": "pressure", "numeric": True, "type_bit": 1, "min": None, "max": None, "range_reason": None, "range_bit": None},
+    # (-145 to 61.2 range mentioned in dataset)
+    {"column": "temperature", "numeric": True, "type_bit": 2, "min": -50, "max": 60, "range_reason": "Temperature out of valid range (-50 to 60)", "range_bit": 7},
+    {"column": "humidity", "numeric": True, "type_bit": 3, "min": 0, "max": 100, "range_reason": "Humidity out of valid range (0 to 100)", "range_bit": 8},
+    # (42.6 to 42.7 range mentioned in dataset)
+    {"column": "latitude", "numeric": True, "type_bit": 4, "min": -90, "max": 90, "range_reason": "Latitude out of valid range (-90 to 90)", "range_bit": 9},
+    # (23.2 to 23.4 range mentioned in dataset)
+    {"column": "longitude", "numeric": True, "type_bit": 5, "min": -180, "max": 180, "range_reason": "Longitude out of valid range (-180 to 180)", "range_bit": 10},
+    {"column": "sensor_id", "numeric": True, "type_bit": 6, "min": None, "max": None, "range_reason": None, "range_bit": None},
+]
+
+# columns parsed as timestamps (utils/dataset_schema.py) - a value not in timestamp_format is reported with
+# timestamp_reason, a missing value with null_reason
+# - type_bit: bit of the timestamp reason in the reason_code bitmask
+timestamp_rules = [
+    {"column": "timestamp", "type_bit": 11},
+]
+
+null_reason = "NULL value found in one or more columns"
+null_bit = 0
+data_type_reason = "Invalid data type in column '{column}'"
+timestamp_reason = f"Invalid timestamp in column '{{column}}' (expected format {timestamp_format})"
+
+# bit of every reason in the reason_code bitmask, in reporting order (NULL check, then the data type, timestamp and
+# range checks in the order of the rules)
+reason_bits = {null_reason: null_bit}
+for rule in validation_rules:
+    if rule["numeric"]:
+        reason_bits[data_type_reason.format(column=rule["column"])] = rule["type_bit"]
+for rule in timestamp_rules:
+    reason_bits[timestamp_reason.format(column=rule["column"])] = rule["type_bit"]
+for rule in validation_rules:
+    if rule["range_reason"] is not None:
+        reason_bits[rule["range_reason"]] = rule["range_bit"]
+if len(set(reason_bits.values())) != len(reason_bits) or not all(0 <= bit < 63 for bit in reason_bits.values()):
+    raise ValueError(f"Validation reason bits must be distinct and between 0 and 62 : {reason_bits}")
+
+def decode_reason_code(reason_code):
+    # reasons of a reason_code bitmask, in reporting order
+    return ", ".join(reason for reason, bit in reason_bits.items() if reason_code & (1 << bit))